@@ -0,0 +1,264 @@
+import pandas as pd
+import numpy as np
+import os
+
+from TCR_DATASETS.TCR_load import data_sources, columnar_path, iter_tcr_data
+
+DIVERSITY_PATH = "TCR_DATASETS/TCR_sequencing_hedimed_DIVERSITY_{NAME}.npz" # cached sketch of each dataset
+HLL_PRECISION = 12 # 2**12 HyperLogLog registers per patient, relative error of estimated richness about 1.04 / sqrt(2**12) = 1.6 %
+CHUNK_SIZE = 1_000_000 # rows read at once
+CLONE_COLUMNS = ["clonotype_sequence", "V_region", "J_region"] # columns of a dataset that identify a clone
+STATISTICS = ["richness", "shannon_entropy", "simpson_index", "clonality", "top_clone_share"]
+
+
+def bit_length(values: np.ndarray) -> np.ndarray:
+    # number of bits of each uint64 value (0 for 0), binary search with shifts
+    values = values.copy()
+    lengths = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = values >= np.uint64(1 << shift)
+        values[high] >>= np.uint64(shift)
+        lengths[high] += shift
+    return lengths + (values > 0)
+
+def hash_clones(chunk: pd.DataFrame) -> np.ndarray:
+    # 64-bit hash of the clone columns of each row, the same for categorical, string and object columns (missing values differ otherwise)
+    clones = pd.DataFrame({column: chunk[column].astype(object) for column in CLONE_COLUMNS if column in chunk.columns})
+    return pd.util.hash_pandas_object(clones, index=False, categorize=False).to_numpy()
+
+
+class DiversitySketch:
+    """
+    Mergeable summary of clone counts of each patient, one row of a dataset is one clone and specific_seq_count is its size.
+    Shannon entropy, Simpson index and top-clone share are computed from sums and maxima of the counts, richness is the
+    exact number of rows. Sketches of parts of the rows (chunks, partitions) are combined by merge: all statistics are exact
+    if every clone is counted in one part. Parts that can share clones are merged with disjoint=False, richness of their
+    patients is then estimated from HyperLogLog registers of the clones, which count a clone present in several parts once.
+    """
+    def __init__(self, precision: int = HLL_PRECISION, patients=None, categories=None, totals=None, clones=None,
+                 entropy_sums=None, square_sums=None, max_counts=None, registers=None, overlapping=None, version: str = ""):
+        self.precision = int(precision)
+        self.patients = np.asarray([] if patients is None else patients, dtype=str)
+        self.categories = np.asarray([] if categories is None else categories, dtype=str) # category of the first row of the patient
+        self.totals = np.zeros(0) if totals is None else np.asarray(totals, dtype=np.float64) # sum of counts (N)
+        self.clones = np.zeros(0, dtype=np.int64) if clones is None else np.asarray(clones, dtype=np.int64) # number of rows
+        self.entropy_sums = np.zeros(0) if entropy_sums is None else np.asarray(entropy_sums, dtype=np.float64) # sum of c * ln(c)
+        self.square_sums = np.zeros(0) if square_sums is None else np.asarray(square_sums, dtype=np.float64) # sum of c ** 2
+        self.max_counts = np.zeros(0) if max_counts is None else np.asarray(max_counts, dtype=np.float64)
+        self.registers = np.zeros((0, 1 << self.precision), dtype=np.uint8) if registers is None else np.asarray(registers, dtype=np.uint8)
+        self.overlapping = np.zeros(len(self.patients), dtype=bool) if overlapping is None else np.asarray(overlapping, dtype=bool) # clones of the patient can be counted twice
+        self.version = str(version) # version of the dataset the sketch was computed from (see dataset_version)
+
+    def __len__(self) -> int:
+        return len(self.patients)
+
+    def save(self, path: str) -> None:
+        # uncompressed npz, replaced at once
+        np.savez(path + ".tmp.npz", **self.__dict__)
+        os.replace(path + ".tmp.npz", path)
+
+    @classmethod
+    def load(cls, path: str) -> "DiversitySketch":
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in arrays.files})
+
+    def add_patients(self, patients, categories) -> np.ndarray:
+        # rows of the patients in the sketch, missing patients are added with empty statistics
+        patients = np.asarray(patients, dtype=str)
+        rows = pd.Index(self.patients).get_indexer(patients)
+        new = rows < 0
+        if new.any():
+            count = int(new.sum())
+            rows[new] = np.arange(len(self), len(self) + count)
+            self.patients = np.concatenate([self.patients, patients[new]])
+            self.categories = np.concatenate([self.categories, np.asarray(categories, dtype=str)[new]])
+            for name in ["totals", "entropy_sums", "square_sums", "max_counts"]:
+                setattr(self, name, np.concatenate([getattr(self, name), np.zeros(count)]))
+            self.clones = np.concatenate([self.clones, np.zeros(count, dtype=np.int64)])
+            self.overlapping = np.concatenate([self.overlapping, np.zeros(count, dtype=bool)])
+            self.registers = np.concatenate([self.registers, np.zeros((count, self.registers.shape[1]), dtype=np.uint8)])
+        return rows
+
+    def update(self, chunk: pd.DataFrame) -> "DiversitySketch":
+        """
+        Add rows of a dataset to the sketch.
+
+        Args:
+        - chunk (pd.DataFrame): Rows with patient_id, category, specific_seq_count and clone columns (clonotype_sequence, V_region, J_region).
+
+        Returns:
+        - DiversitySketch: The updated sketch.
+        """
+        chunk = chunk[chunk["patient_id"].notna().to_numpy()]
+        if not len(chunk):
+            return self
+        patient_codes, patients = pd.factorize(chunk["patient_id"])
+        first_rows = np.unique(patient_codes, return_index=True)[1]
+        rows = self.add_patients(np.asarray(patients, dtype=str), chunk["category"].astype(str).to_numpy()[first_rows])[patient_codes]
+
+        # sums and maxima of the counts of each patient
+        counts = chunk["specific_seq_count"].to_numpy(dtype=np.float64)
+        size = len(self)
+        self.totals += np.bincount(rows, weights=counts, minlength=size)
+        self.clones += np.bincount(rows, minlength=size)
+        self.entropy_sums += np.bincount(rows, weights=counts * np.log(np.maximum(counts, 1)), minlength=size)
+        self.square_sums += np.bincount(rows, weights=counts ** 2, minlength=size)
+        np.maximum.at(self.max_counts, rows, counts)
+
+        # HyperLogLog: the first bits of the hash of a clone select a register, which keeps the maximal rank of the first set bit of the rest
+        hashes = hash_clones(chunk)
+        rest_bits = 64 - self.precision
+        buckets = (hashes >> np.uint64(rest_bits)).astype(np.int64)
+        ranks = rest_bits + 1 - bit_length(hashes & np.uint64((1 << rest_bits) - 1))
+        np.maximum.at(self.registers.reshape(-1), rows * self.registers.shape[1] + buckets, ranks.astype(np.uint8))
+        return self
+
+    def merge(self, other: "DiversitySketch", disjoint: bool = True) -> "DiversitySketch":
+        """
+        Add another sketch, e.g. of another part of the rows.
+
+        Args:
+        - other (DiversitySketch): Sketch with the same precision.
+        - disjoint (bool): Whether every clone is counted in one of the sketches only, e.g. sketches of partitions of a dataset.
+          Otherwise richness of patients in both sketches is estimated from the HyperLogLog registers.
+
+        Returns:
+        - DiversitySketch: The merged sketch.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Sketches with different precision can not be merged")
+        rows = self.add_patients(other.patients, other.categories)
+        self.overlapping[rows] |= other.overlapping
+        if not disjoint:
+            self.overlapping[rows] |= (self.clones[rows] > 0) & (other.clones > 0)
+        for name in ["totals", "clones", "entropy_sums", "square_sums"]:
+            getattr(self, name)[rows] += getattr(other, name)
+        self.max_counts[rows] = np.maximum(self.max_counts[rows], other.max_counts)
+        self.registers[rows] = np.maximum(self.registers[rows], other.registers)
+        return self
+
+    def select(self, patients: list, exclude: bool = False) -> "DiversitySketch":
+        # sketch of the patients, or of all other patients if exclude is True
+        keep = np.isin(self.patients, np.asarray(list(patients), dtype=str)) != exclude
+        return DiversitySketch(self.precision, self.patients[keep], self.categories[keep], self.totals[keep], self.clones[keep],
+                               self.entropy_sums[keep], self.square_sums[keep], self.max_counts[keep], self.registers[keep], self.overlapping[keep], self.version)
+
+    def richness(self) -> np.ndarray:
+        # number of distinct clones of each patient, estimated only for patients whose clones can be counted twice
+        return np.where(self.overlapping, self.estimated_richness(), self.clones)
+
+    def estimated_richness(self) -> np.ndarray:
+        # HyperLogLog estimate of the number of distinct clones of each patient, linear counting for small counts
+        registers_count = self.registers.shape[1]
+        alpha = 0.7213 / (1 + 1.079 / registers_count)
+        powers = np.exp2(-np.arange(65, dtype=np.float64)) # 2 ** -rank for every possible rank
+        estimates = np.empty(len(self))
+        for start in range(0, len(self), 1024): # blocks of patients, the float matrix of all registers would be 8x larger
+            block = self.registers[start:start + 1024]
+            estimates[start:start + 1024] = alpha * registers_count ** 2 / powers[block].sum(axis=1)
+        zeros = (self.registers == 0).sum(axis=1)
+        small = (estimates <= 2.5 * registers_count) & (zeros > 0)
+        estimates[small] = registers_count * np.log(registers_count / zeros[small])
+        return estimates
+
+    def statistics(self) -> pd.DataFrame:
+        """
+        Diversity statistics of each patient.
+
+        Returns:
+        - pd.DataFrame: patient_id, category, total_count (N), clones (rows), richness (number of distinct clones, see merge),
+          shannon_entropy (-sum p ln p), simpson_index (sum p ** 2), clonality (1 - shannon_entropy / ln richness)
+          and top_clone_share (largest clone / N), sorted by patient_id.
+        """
+        richness = self.richness()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            shannon_entropy = np.log(self.totals) - self.entropy_sums / self.totals
+            clonality = np.where(richness > 1, 1 - shannon_entropy / np.log(np.maximum(richness, 2)), 0.0)
+            statistics = pd.DataFrame({
+                "patient_id": self.patients,
+                "category": self.categories,
+                "total_count": self.totals.astype(np.int64),
+                "clones": self.clones,
+                "richness": np.round(richness).astype(np.int64),
+                "shannon_entropy": shannon_entropy,
+                "simpson_index": self.square_sums / self.totals ** 2,
+                "clonality": np.clip(clonality, 0, 1), # estimated richness (see merge) can be below the effective number of clones
+                "top_clone_share": self.max_counts / self.totals,
+            })
+        return statistics.sort_values(by="patient_id").reset_index(drop=True)
+
+
+def diversity_path(NAME: str) -> str:
+    # TCR_DATASETS/TCR_sequencing_hedimed_DIVERSITY_VJ_DEPENDENT.npz
+    return DIVERSITY_PATH.format(NAME=NAME)
+
+def dataset_version(NAME: str) -> str:
+    # size and modification time of the dataset files, changes whenever the dataset is exported
+    file_path = data_sources[NAME][0]
+    return ";".join(f"{os.path.getsize(file)}:{os.stat(file).st_mtime_ns}" for file in (file_path, columnar_path(file_path)) if os.path.exists(file))
+
+def compute_diversity(NAME: str = "VJ_DEPENDENT", chunksize: int = CHUNK_SIZE, precision: int = HLL_PRECISION) -> DiversitySketch:
+    """
+    Compute the diversity sketch of a dataset in one pass over its rows, memory depends on the chunk size and number of patients.
+
+    Args:
+    - NAME (str): Name of the dataset (see load_tcr_data).
+    - chunksize (int): Number of rows read at once.
+    - precision (int): HyperLogLog precision, 2 ** precision registers per patient.
+
+    Returns:
+    - DiversitySketch: Sketch of all patients of the dataset.
+    """
+    columns = ["patient_id", "category", "specific_seq_count"] + [column for column in CLONE_COLUMNS if column in data_sources[NAME][1]]
+    sketch = DiversitySketch(precision, version=dataset_version(NAME))
+    for chunk in iter_tcr_data(NAME, columns=columns, chunksize=chunksize):
+        sketch.update(chunk)
+    return sketch
+
+def load_diversity(NAME: str = "VJ_DEPENDENT", patients: list = None) -> pd.DataFrame:
+    """
+    Load diversity statistics of patients (see DiversitySketch.statistics). The statistics of all patients are cached,
+    they are computed again only if the dataset changed since.
+
+    Args:
+    - NAME (str): Name of the dataset (see load_tcr_data).
+    - patients (list): Patients to return, all patients if None.
+
+    Returns:
+    - pd.DataFrame: Statistics of each patient.
+    """
+    path = diversity_path(NAME)
+    sketch = DiversitySketch.load(path) if os.path.exists(path) else None
+    if sketch is None or sketch.version != dataset_version(NAME):
+        sketch = compute_diversity(NAME)
+        sketch.save(path)
+        print(f"Diversity statistics of {NAME} computed. Patients: {len(sketch)}")
+    if patients is not None:
+        sketch = sketch.select(patients)
+    return sketch.statistics()
+
+def update_diversity(NAME: str, version: str, new_rows: pd.DataFrame, patients: set) -> bool:
+    """
+    Update the cached sketch after rows of some patients were replaced in the dataset (see update_datasets).
+    Sketches of other patients are kept, so only the new rows are read.
+
+    Args:
+    - NAME (str): Name of the dataset.
+    - version (str): Version of the dataset before the rows were replaced (see dataset_version).
+    - new_rows (pd.DataFrame): New rows of the patients.
+    - patients (set): Patients whose rows were replaced or removed.
+
+    Returns:
+    - bool: Whether the cache was updated, False if there was no cached sketch of the previous dataset.
+    """
+    path = diversity_path(NAME)
+    if not os.path.exists(path):
+        return False
+    sketch = DiversitySketch.load(path)
+    if sketch.version != version:
+        return False
+
+    sketch = sketch.select(patients, exclude=True).update(new_rows)
+    sketch.version = dataset_version(NAME)
+    sketch.save(path)
+    return True
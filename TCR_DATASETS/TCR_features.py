@@ -0,0 +1,108 @@
+import pandas as pd
+import numpy as np
+
+from TCR_DATASETS.TCR_load import make_vj_region
+from TCR_DATASETS.TCR_diversity import STATISTICS
+
+try:
+    from scipy import sparse
+except ImportError: # sparse feature matrices need scipy
+    sparse = None
+
+VALUE_COLUMNS = ["ratio", "specific_seq_count"]
+
+
+def aggregate_patient_regions(data_df: pd.DataFrame, region_column: str = "VJ_region") -> pd.DataFrame:
+    """
+    Sum ratio and specific_seq_count of each region for each patient.
+
+    Args:
+    - data_df (pd.DataFrame): TCR data with patient_id, category, ratio and specific_seq_count columns
+      and the region column (VJ_region is made from V_region and J_region if missing).
+    - region_column (str): The column name for regions in the dataset.
+
+    Returns:
+    - pd.DataFrame: patient_id, category, region, ratio and specific_seq_count for each patient and region, sorted by patient_id.
+    """
+    regions = make_vj_region(data_df) if region_column == "VJ_region" and region_column not in data_df.columns else data_df[region_column]
+    patient_regions = data_df[["patient_id", "category"] + VALUE_COLUMNS].assign(**{region_column: regions})
+    return patient_regions.groupby(["patient_id", "category", region_column], observed=True)[VALUE_COLUMNS].sum().reset_index()
+
+def encode_patient_regions(patient_regions: pd.DataFrame, regions: list = None, region_column: str = "VJ_region") -> tuple:
+    # integer codes of patients and regions - rows and columns of the feature matrix
+    if regions is not None:
+        patient_regions = patient_regions[patient_regions[region_column].isin(regions)]
+    patient_codes, patient_ids = pd.factorize(patient_regions["patient_id"], sort=True)
+
+    if regions is None:
+        region_codes, regions = pd.factorize(patient_regions[region_column], sort=True)
+    else:
+        region_codes = pd.Index(regions).get_indexer(patient_regions[region_column])
+
+    # category of each patient from its first row
+    categories = pd.Series(patient_regions["category"].to_numpy()).groupby(patient_codes, sort=True).first().to_numpy()
+    return patient_regions, patient_codes, np.asarray(patient_ids), region_codes, list(regions), categories
+
+def build_feature_matrix(patient_regions: pd.DataFrame, regions: list = None, value: str = "ratio", region_column: str = "VJ_region") -> pd.DataFrame:
+    """
+    Make a dataframe with one row for each patient and one column for each region (patients x regions scatter, no loops).
+    Patients without any of the regions are left out.
+
+    Args:
+    - patient_regions (pd.DataFrame): Output of aggregate_patient_regions.
+    - regions (list): Regions used as features, all regions if None.
+    - value (str): Column used as feature values ('ratio' or 'specific_seq_count').
+    - region_column (str): The column name for regions in the dataset.
+
+    Returns:
+    - pd.DataFrame: patient_id, one column for each region (0 if the patient does not have the region) and category.
+    """
+    patient_regions, patient_codes, patient_ids, region_codes, regions, categories = encode_patient_regions(patient_regions, regions, region_column)
+
+    values = patient_regions[value].to_numpy()
+    cells = np.bincount(patient_codes * len(regions) + region_codes, weights=values, minlength=len(patient_ids) * len(regions))
+    matrix = cells.reshape(len(patient_ids), len(regions)).astype(values.dtype)
+
+    dataset = pd.DataFrame(matrix, columns=regions)
+    dataset.insert(0, "patient_id", patient_ids)
+    dataset["category"] = categories
+    return dataset
+
+def build_sparse_feature_matrix(patient_regions: pd.DataFrame, regions: list = None, value: str = "ratio", region_column: str = "VJ_region") -> tuple:
+    """
+    Same as build_feature_matrix, but as a sparse CSR matrix - for the full region vocabulary most cells are 0.
+
+    Args:
+    - patient_regions (pd.DataFrame): Output of aggregate_patient_regions.
+    - regions (list): Regions used as features, all regions if None.
+    - value (str): Column used as feature values ('ratio' or 'specific_seq_count').
+    - region_column (str): The column name for regions in the dataset.
+
+    Returns:
+    - tuple: CSR matrix (patients x regions), patient_ids (rows), regions (columns) and category of each patient.
+    """
+    if sparse is None:
+        raise ImportError("scipy is required for sparse feature matrices")
+
+    patient_regions, patient_codes, patient_ids, region_codes, regions, categories = encode_patient_regions(patient_regions, regions, region_column)
+    matrix = sparse.csr_matrix((patient_regions[value].to_numpy(), (patient_codes, region_codes)), shape=(len(patient_ids), len(regions)))
+    return matrix, patient_ids, regions, categories
+
+def add_diversity_features(dataset: pd.DataFrame, diversity: pd.DataFrame, columns: list = STATISTICS) -> pd.DataFrame:
+    """
+    Add diversity statistics of each patient as features (see TCR_diversity.load_diversity).
+
+    Args:
+    - dataset (pd.DataFrame): Output of build_feature_matrix.
+    - diversity (pd.DataFrame): Statistics of the patients with patient_id column.
+    - columns (list): Statistics added as features.
+
+    Returns:
+    - pd.DataFrame: The dataset with the statistics before the category column, NaN for patients without statistics.
+    """
+    features = dataset[["patient_id"]].merge(diversity[["patient_id"] + list(columns)], on="patient_id", how="left")
+    dataset = dataset.drop(columns=[column for column in columns if column in dataset.columns])
+    position = dataset.columns.get_loc("category")
+    for offset, column in enumerate(columns):
+        dataset.insert(position + offset, column, features[column].to_numpy())
+    return dataset
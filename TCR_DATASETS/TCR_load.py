@@ -1,5 +1,16 @@
 import pandas as pd
-from typing import Literal
+import numpy as np
+import os
+from typing import Iterator, Literal
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError: # without pyarrow only CSV files are used
+    pa = None
+    pc = None
+    pq = None
 
 Integrity: bool = False
 
@@ -36,6 +47,10 @@ VJ_DEPENDENT_COLUMNS["J_region"] = str
 
 VJ_INDEPENDENT_COLUMNS = Base_columns.copy()
 
+# columns with few distinct values - stored as dictionary columns and loaded as pandas categoricals
+CATEGORICAL_COLUMNS = ["patient_id", "category", "V_region", "J_region"]
+ROW_GROUP_SIZE = 100_000 # datasets are sorted by patient_id, small row groups let patient filters skip most of the file
+
 
 data_sources = {
         'J_DEPENDENT': (J_DEPENDENT, J_DEPENDENT_COLUMNS),
@@ -53,12 +68,271 @@ def tcr_info() -> None:
     print("TCR_DATASETS/TCR_sequencing_hedimed_DATASET_ratio_VJ_independent.csv - NAME: VJ_INDEPENDENT")
 
 
+def columnar_path(file_path: str) -> str:
+    # TCR_DATASETS/TCR_sequencing_hedimed_DATASET_J_dependent.csv -> TCR_DATASETS/TCR_sequencing_hedimed_DATASET_J_dependent.parquet
+    return os.path.splitext(file_path)[0] + ".parquet"
+
+def mapped_path(file_path: str) -> str:
+    # TCR_DATASETS/TCR_sequencing_hedimed_DATASET_J_dependent.csv -> TCR_DATASETS/TCR_sequencing_hedimed_DATASET_J_dependent.arrow
+    return os.path.splitext(file_path)[0] + ".arrow"
+
+def is_current(path: str, file_path: str) -> bool:
+    # Parquet/Arrow file exists and is not older than the CSV file (a CSV exported without them makes them stale)
+    return os.path.exists(path) and (not os.path.exists(file_path) or os.path.getmtime(file_path) <= os.path.getmtime(path))
+
+def save_tcr_data(df: pd.DataFrame, file_path: str, memory_map: bool = True) -> None:
+    """
+    Save a dataset in columnar Parquet format next to its CSV file. Categorical columns are dictionary encoded.
+
+    Args:
+    - df (pd.DataFrame): Dataset to save.
+    - file_path (str): Path of the CSV file of the dataset.
+    - memory_map (bool): Whether to write an uncompressed Arrow file for lazy loading too (see load_tcr_data).
+    """
+    if pq is None:
+        raise ImportError("pyarrow is required to save TCR data in Parquet format")
+
+    df = df.astype({column: "category" for column in CATEGORICAL_COLUMNS if column in df.columns})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, columnar_path(file_path), row_group_size=ROW_GROUP_SIZE)
+
+    if memory_map:
+        # Arrow IPC file is not compressed, so its buffers can be used directly from a memory map
+        with pa.OSFile(mapped_path(file_path), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table, max_chunksize=ROW_GROUP_SIZE)
+
+def convert_tcr_data() -> None:
+    # Write Parquet (and Arrow) files for all existing CSV datasets
+    for NAME, (file_path, columns) in data_sources.items():
+        if os.path.exists(file_path):
+            save_tcr_data(pd.read_csv(file_path, dtype=columns, usecols=columns.keys()), file_path)
+            print(f"{NAME} converted to {columnar_path(file_path)}")
+
+def make_vj_region(df: pd.DataFrame) -> pd.Series:
+    """
+    Combine V_region and J_region into VJ_region (V10-1 + J2-7 -> V10-1_J2-7).
+    Categorical regions are combined by their codes, so strings are built only once for each distinct pair.
+
+    Args:
+    - df (pd.DataFrame): Dataset with V_region and J_region columns.
+
+    Returns:
+    - pd.Series: VJ_region column, categorical if both regions are categorical.
+    """
+    if not (isinstance(df["V_region"].dtype, pd.CategoricalDtype) and isinstance(df["J_region"].dtype, pd.CategoricalDtype)):
+        return df["V_region"] + "_" + df["J_region"]
+
+    v_codes = df["V_region"].cat.codes.to_numpy().astype(np.int64)
+    j_codes = df["J_region"].cat.codes.to_numpy().astype(np.int64)
+    j_count = len(df["J_region"].cat.categories)
+    pair_codes = np.where((v_codes < 0) | (j_codes < 0), -1, v_codes * j_count + j_codes) # -1 = missing region
+
+    # rows with a missing region keep code -1 (NaN), only present pairs get names
+    present = pair_codes >= 0
+    codes = np.full(len(pair_codes), -1, dtype=np.int64)
+    codes[present], pairs = pd.factorize(pair_codes[present])
+    names = df["V_region"].cat.categories[pairs // j_count].astype(str) + "_" + df["J_region"].cat.categories[pairs % j_count].astype(str)
+    return pd.Series(pd.Categorical.from_codes(codes, categories=names), index=df.index)
+
+def make_filters(patients: list = None, categories: list = None, V_regions: list = None, J_regions: list = None, min_specific_seq_count: int = None) -> list:
+    # filters in pyarrow format: (column, operator, value)
+    filters = [(column, "in", list(values)) for column, values in
+               [("patient_id", patients), ("category", categories), ("V_region", V_regions), ("J_region", J_regions)] if values is not None]
+    if min_specific_seq_count is not None:
+        filters.append(("specific_seq_count", ">=", min_specific_seq_count))
+    return filters
+
+class TCRDataView:
+    """
+    Lazily loaded dataset backed by memory-mapped Arrow buffers (see load_tcr_data with lazy=True).
+    Rows of a patient are stored together, so selecting patients or categories only slices the mapped table.
+    Region and count filters copy just the matching rows and pandas dataframes are made only by to_pandas.
+    """
+    def __init__(self, table: "pa.Table", columns: list = None):
+        self.table = table
+        self.columns = table.column_names if columns is None else list(columns) # default columns of to_pandas
+        self._runs = None
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def runs(self) -> pd.DataFrame:
+        """
+        Find runs of rows that belong to one patient.
+
+        Returns:
+        - pd.DataFrame: patient_id, category, start and stop row of each run.
+        """
+        if self._runs is None:
+            codes, patient_ids = pd.factorize(self.table["patient_id"].to_pandas())
+            starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.array([], dtype=np.int64)
+            self._runs = pd.DataFrame({"patient_id": np.asarray(patient_ids)[codes[starts]], "start": starts, "stop": np.r_[starts[1:], len(codes)].astype(np.int64)})
+            if "category" in self.table.column_names:
+                self._runs["category"] = self.table["category"].take(pa.array(starts)).to_pandas().astype(str).to_numpy()
+        return self._runs
+
+    @property
+    def patients(self) -> list:
+        return list(pd.unique(self.runs()["patient_id"]))
+
+    def select(self, patients: list = None, categories: list = None, V_regions: list = None, J_regions: list = None,
+               min_specific_seq_count: int = None) -> "TCRDataView":
+        """
+        Select rows of the view. Arguments are the same as in load_tcr_data.
+
+        Returns:
+        - TCRDataView: View of the selected rows.
+        """
+        table = self.table
+        if patients is not None or categories is not None:
+            runs = self.runs()
+            keep = np.ones(len(runs), dtype=bool)
+            if patients is not None: keep &= runs["patient_id"].isin(list(patients)).to_numpy()
+            if categories is not None: keep &= runs["category"].isin(list(categories)).to_numpy()
+
+            # zero-copy slices, neighbouring runs are joined into one slice
+            slices: list = []
+            for start, stop in zip(runs["start"].to_numpy()[keep], runs["stop"].to_numpy()[keep]):
+                if slices and slices[-1][1] == start: slices[-1][1] = stop
+                else: slices.append([start, stop])
+            table = pa.concat_tables([table.slice(start, stop - start) for start, stop in slices]) if slices else table.slice(0, 0)
+
+        mask = None
+        for column, operator, value in make_filters(V_regions=V_regions, J_regions=J_regions, min_specific_seq_count=min_specific_seq_count):
+            if operator == "in":
+                column_mask = pc.is_in(pc.cast(table[column], pa.string()), value_set=pa.array(value, type=pa.string()))
+            else:
+                column_mask = pc.greater_equal(table[column], value)
+            mask = column_mask if mask is None else pc.and_(mask, column_mask)
+        if mask is not None:
+            table = table.filter(mask)
+
+        return TCRDataView(table, self.columns)
+
+    def iter_patients(self):
+        # yield patient_id and zero-copy view of its rows
+        for patient_id in self.patients:
+            yield patient_id, self.select(patients=[patient_id])
+
+    def to_pandas(self, columns: list = None, categorical: bool = True) -> pd.DataFrame:
+        """
+        Make a dataframe of the view.
+
+        Args:
+        - columns (list): Columns of the dataframe, columns of the view if None.
+        - categorical (bool): Whether to return patient_id, category, V_region and J_region as categoricals.
+
+        Returns:
+        - pd.DataFrame: Selected rows and columns.
+        """
+        tcr_data = self.table.select(self.columns if columns is None else list(columns)).to_pandas()
+        if not categorical:
+            tcr_data = tcr_data.astype({column: str for column in CATEGORICAL_COLUMNS if column in tcr_data.columns})
+        return tcr_data
+
+def iter_tcr_data(NAME: Literal['J_DEPENDENT', 'V_DEPENDENT', 'VJ_DEPENDENT', 'VJ_INDEPENDENT'], columns: list = None,
+                  chunksize: int = ROW_GROUP_SIZE, categorical: bool = True) -> Iterator[pd.DataFrame]:
+    """
+    Read a TCR dataset in chunks of rows, memory depends on chunksize and not on the size of the dataset.
+    The Parquet file is used if it exists and is not older than the CSV file, otherwise the CSV file is read.
+
+    Args:
+    - NAME (str): Name of the dataset (see tcr_info).
+    - columns (list): Columns to read, all columns if None.
+    - chunksize (int): Number of rows in each chunk.
+    - categorical (bool): Whether to return patient_id, category, V_region and J_region as categoricals.
+
+    Returns:
+    - Iterator[pd.DataFrame]: Chunks in order of the file, index of a chunk is the row number in the dataset (0 = first row).
+    """
+    if NAME in data_sources:
+        file_path, dtypes = data_sources[NAME]
+    else:
+        raise ValueError("Invalid TCR data name")
+
+    if pq is not None and is_current(columnar_path(file_path), file_path):
+        parquet_file = pq.ParquetFile(columnar_path(file_path))
+        if columns is None:
+            columns = [column for column in parquet_file.schema_arrow.names if column in dtypes]
+        chunks = (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunksize, columns=list(columns)))
+    else:
+        read_columns = list(dtypes.keys()) if columns is None else list(columns)
+        read_dtypes = {column: "category" if categorical and column in CATEGORICAL_COLUMNS else dtypes[column] for column in read_columns}
+        chunks = pd.read_csv(file_path, dtype=read_dtypes, usecols=read_columns, chunksize=chunksize, float_precision="round_trip")
+
+    start = 0
+    for chunk in chunks:
+        if columns is not None:
+            chunk = chunk[list(columns)]
+        if not categorical:
+            chunk = chunk.astype({column: str for column in CATEGORICAL_COLUMNS if column in chunk.columns})
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        start += len(chunk)
+        yield chunk
+
 # Load TCR data
-def load_tcr_data(NAME: Literal['J_DEPENDENT', 'V_DEPENDENT', 'VJ_DEPENDENT', 'VJ_INDEPENDENT'], check_integrity = False) -> pd.DataFrame:
+def load_tcr_data(NAME: Literal['J_DEPENDENT', 'V_DEPENDENT', 'VJ_DEPENDENT', 'VJ_INDEPENDENT'], check_integrity = False,
+                  columns: list = None, patients: list = None, categories: list = None, V_regions: list = None, J_regions: list = None,
+                  min_specific_seq_count: int = None, categorical: bool = True, lazy: bool = False, sequence_store = None):
+    """
+    Load a TCR dataset. The Parquet file is used if it exists and is not older than the CSV file (see save_tcr_data), otherwise the CSV file is read.
+    Filters are pushed down to the Parquet reader, so row groups without matching rows are skipped.
+
+    Args:
+    - NAME (str): Name of the dataset (see tcr_info).
+    - columns (list): Columns to load, all columns if None.
+    - patients (list): Load only rows of these patient_ids, all patients if None.
+    - categories (list): Load only rows of these categories, all categories if None.
+    - V_regions (list): Load only rows with these V regions, all V regions if None.
+    - J_regions (list): Load only rows with these J regions, all J regions if None.
+    - min_specific_seq_count (int): Load only rows with at least this specific_seq_count.
+    - categorical (bool): Whether to return patient_id, category, V_region and J_region as categoricals.
+    - lazy (bool): Return TCRDataView of the memory-mapped Arrow file instead of a dataframe. The Arrow file is created on first use or when the CSV file is newer.
+    - sequence_store (SequenceStore): Return clonotype_sequence as int32 codes of the store (see TCR_sequences), unknown sequences are added to it.
+      Each distinct sequence is converted to a Python string only once.
+
+    Returns:
+    - pd.DataFrame | TCRDataView: Loaded dataset.
+    """
     if NAME in data_sources:
-        file_path, columns = data_sources[NAME]
-        tcr_data = pd.read_csv(file_path, dtype=columns, usecols=columns.keys())
+        file_path, dtypes = data_sources[NAME]
     else:
         raise ValueError("Invalid TCR data name")
-    
+
+    if lazy:
+        if pa is None:
+            raise ImportError("pyarrow is required to load TCR data lazily")
+        if not is_current(mapped_path(file_path), file_path):
+            save_tcr_data(load_tcr_data(NAME), file_path) # Arrow file is made from the current Parquet or CSV file
+
+        table = pa.ipc.open_file(pa.memory_map(mapped_path(file_path), "r")).read_all() # buffers point into the memory map, nothing is read yet
+        return TCRDataView(table, columns).select(patients, categories, V_regions, J_regions, min_specific_seq_count)
+
+    filters = make_filters(patients, categories, V_regions, J_regions, min_specific_seq_count)
+
+    if pq is not None and is_current(columnar_path(file_path), file_path):
+        if columns is None:
+            columns = [column for column in pq.read_schema(columnar_path(file_path)).names if column in dtypes] # keep order of the file
+        # only the projected columns are read, row groups without matching rows are skipped
+        read_dictionary = ["clonotype_sequence"] if sequence_store is not None and "clonotype_sequence" in columns else None
+        tcr_data = pq.read_table(columnar_path(file_path), columns=list(columns), filters=filters or None, read_dictionary=read_dictionary).to_pandas()
+        if not categorical:
+            tcr_data = tcr_data.astype({column: str for column in CATEGORICAL_COLUMNS if column in tcr_data.columns})
+    else:
+        read_columns = list(dtypes.keys()) if columns is None else list(columns)
+        read_columns += [column for column, _, _ in filters if column not in read_columns]
+        read_dtypes = {column: "category" if categorical and column in CATEGORICAL_COLUMNS else dtypes[column] for column in read_columns}
+        if sequence_store is not None and "clonotype_sequence" in read_dtypes:
+            read_dtypes["clonotype_sequence"] = "category"
+        tcr_data = pd.read_csv(file_path, dtype=read_dtypes, usecols=read_columns, float_precision="round_trip") # ratios are exported again unchanged (see update_datasets)
+        for column, operator, value in filters:
+            mask = tcr_data[column].isin(value) if operator == "in" else tcr_data[column] >= value
+            tcr_data = tcr_data[mask].reset_index(drop=True)
+        if columns is not None:
+            tcr_data = tcr_data[list(columns)]
+
+    if sequence_store is not None and "clonotype_sequence" in tcr_data.columns:
+        tcr_data["clonotype_sequence"] = sequence_store.encode(tcr_data["clonotype_sequence"])
+
     return pd.DataFrame(tcr_data)
@@ -0,0 +1,81 @@
+import pandas as pd
+import numpy as np
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError: # the sequence store is kept in pyarrow arrays
+    pa = None
+
+SEQUENCES_PATH = "TCR_DATASETS/TCR_sequencing_hedimed_SEQUENCES.arrow" # global CDR3 dictionary, code of a sequence is its row number
+
+
+class SequenceStore:
+    """
+    Global dictionary of clonotype sequences (CDR3). Every distinct sequence gets an int32 code, codes never change
+    once given, so encoded datasets can be grouped, deduplicated and joined on codes and decoded only for export.
+    Sequences are kept in an Arrow array, a loaded store points into the memory-mapped file and is not converted to Python strings.
+    """
+
+    def __init__(self, sequences = None):
+        if pa is None:
+            raise ImportError("pyarrow is required for the sequence store")
+        if sequences is None:
+            sequences = pa.chunked_array([], type=pa.large_string())
+        elif not isinstance(sequences, pa.ChunkedArray):
+            sequences = pa.chunked_array([pa.array(sequences, type=pa.large_string(), from_pandas=True)])
+        self.sequences = sequences
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+    @classmethod
+    def load(cls, path: str = SEQUENCES_PATH) -> "SequenceStore":
+        # empty store if the file does not exist yet, the file is memory-mapped
+        if not os.path.exists(path):
+            return cls()
+        if pa is None:
+            raise ImportError("pyarrow is required to load the sequence store")
+        table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all() # buffers point into the memory map
+        return cls(table.column("clonotype_sequence"))
+
+    def save(self, path: str = SEQUENCES_PATH) -> None:
+        # uncompressed Arrow file, replaced at once so readers never see a partial store
+        if pa is None:
+            raise ImportError("pyarrow is required to save the sequence store")
+        table = pa.table({"clonotype_sequence": self.sequences})
+        with pa.OSFile(path + ".tmp", "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(path + ".tmp", path)
+
+    def encode(self, values, add: bool = True) -> np.ndarray:
+        """
+        Codes of the sequences. Values are looked up in a hash table of the store built by Arrow.
+
+        Args:
+        - values: Sequences (array-like or pd.Series, categorical series are encoded by their categories).
+        - add (bool): Whether to add unknown sequences to the store, otherwise their code is -1.
+
+        Returns:
+        - np.ndarray: int32 code of each value.
+        """
+        if isinstance(getattr(values, "dtype", None), pd.CategoricalDtype):
+            category_codes = self.encode(values.cat.categories, add)
+            codes = values.cat.codes.to_numpy()
+            return np.where(codes < 0, np.int32(-1), category_codes[codes]).astype(np.int32)
+
+        values = pa.array(values, type=pa.large_string(), from_pandas=True)
+        codes = pc.index_in(values, value_set=self.sequences)
+        unknown = pc.and_(pc.is_null(codes), pc.is_valid(values))
+        if add and pc.any(unknown).as_py():
+            new = pc.unique(values.filter(unknown))
+            codes = pc.coalesce(codes, pc.add(pc.index_in(values, value_set=new), len(self)))
+            self.sequences = pa.chunked_array(self.sequences.chunks + [new], type=pa.large_string())
+        return codes.fill_null(-1).to_numpy(zero_copy_only=False).astype(np.int32)
+
+    def decode(self, codes) -> np.ndarray:
+        # sequences of the codes, -1 -> missing, only the taken sequences become Python strings
+        codes = np.asarray(codes)
+        return self.sequences.take(pa.array(codes, mask=codes < 0)).to_numpy(zero_copy_only=False)
@@ -0,0 +1,294 @@
+import pandas as pd
+import numpy as np
+import os
+from itertools import combinations
+
+from TCR_DATASETS.TCR_load import load_tcr_data, data_sources, columnar_path
+
+try:
+    from scipy import sparse
+    from scipy.sparse.csgraph import connected_components
+except ImportError: # clustering needs scipy
+    sparse = None
+
+SIMILARITY_PATH = "TCR_DATASETS/TCR_sequencing_hedimed_SIMILARITY.npz"
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15) # keys of masked sequences, colliding keys are removed by the mismatch check
+
+
+class SimilarityIndex:
+    """
+    Index of distinct clonotype sequences (CDR3) and patients they occur in. Sequences are bucketed by length and stored as
+    uint8 matrices (one row for each sequence, rows sorted), so exact lookups are binary searches and Hamming distances
+    are computed on whole buckets at once. Sequence id is the row number over all buckets.
+    """
+
+    def __init__(self, chars: np.ndarray, lengths: np.ndarray, starts: np.ndarray, offsets: np.ndarray,
+                 occurrence_offsets: np.ndarray, occurrence_patients: np.ndarray, patients: np.ndarray,
+                 patient_categories: np.ndarray, categories: np.ndarray):
+        self.chars = chars # all sequences, concatenated
+        self.lengths = lengths # sequence length of each bucket
+        self.starts = starts # first sequence id of each bucket, last item is the number of sequences
+        self.offsets = offsets # first byte of each bucket in chars
+        self.occurrence_offsets = occurrence_offsets # patients of sequence i are occurrence_patients[occurrence_offsets[i]:occurrence_offsets[i + 1]]
+        self.occurrence_patients = occurrence_patients
+        self.patients = patients
+        self.patient_categories = patient_categories # category code of each patient
+        self.categories = categories
+
+    def __len__(self) -> int:
+        return int(self.starts[-1])
+
+    def save(self, path: str = SIMILARITY_PATH) -> None:
+        # uncompressed npz, replaced at once
+        np.savez(path + ".tmp.npz", **self.__dict__)
+        os.replace(path + ".tmp.npz", path)
+
+    @classmethod
+    def load(cls, path: str = SIMILARITY_PATH) -> "SimilarityIndex":
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in arrays.files})
+
+    def bucket(self, index: int) -> np.ndarray:
+        # sequences of the bucket as a (sequences x length) uint8 matrix, a view of chars
+        length = int(self.lengths[index])
+        return self.chars[self.offsets[index]:self.offsets[index] + (self.starts[index + 1] - self.starts[index]) * length].reshape(-1, length)
+
+    def decode(self, ids) -> np.ndarray:
+        # sequences of the ids
+        ids = np.asarray(ids, dtype=np.int64)
+        decoded = np.empty(len(ids), dtype=object)
+        buckets = np.searchsorted(self.starts, ids, side="right") - 1
+        for index in np.unique(buckets):
+            selected = buckets == index
+            rows = self.bucket(index)[ids[selected] - self.starts[index]]
+            decoded[selected] = np.ascontiguousarray(rows).view(f"S{self.lengths[index]}").ravel().astype(str)
+        return decoded
+
+    def lookup(self, sequences) -> np.ndarray:
+        """
+        Ids of the sequences, -1 for sequences that are not in the index.
+
+        Args:
+        - sequences: Sequences to look up.
+
+        Returns:
+        - np.ndarray: Sequence id of each sequence.
+        """
+        sequences = pd.Series(np.asarray(sequences, dtype=object))
+        ids = np.full(len(sequences), -1, dtype=np.int64)
+        lengths = sequences.str.len().fillna(-1).astype(int).to_numpy()
+        for index, length in enumerate(self.lengths):
+            selected = np.flatnonzero(lengths == length)
+            if not len(selected):
+                continue
+            # rows of a bucket are sorted, bytes of ASCII sequences sort the same way
+            bucket = self.bucket(index).view(f"S{length}").ravel()
+            queries = np.array([sequence.encode("ascii") for sequence in sequences.to_numpy()[selected]], dtype=f"S{length}")
+            positions = np.minimum(np.searchsorted(bucket, queries), len(bucket) - 1)
+            found = bucket[positions] == queries
+            ids[selected[found]] = positions[found] + self.starts[index]
+        return ids
+
+    def occurrence_codes(self, ids) -> tuple:
+        # sequence id and patient code of every (sequence, patient) pair of the sequences
+        ids = np.asarray(ids, dtype=np.int64)
+        counts = self.occurrence_offsets[ids + 1] - self.occurrence_offsets[ids]
+        positions = np.repeat(self.occurrence_offsets[ids] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return np.repeat(ids, counts), self.occurrence_patients[positions]
+
+    def occurrences(self, ids) -> pd.DataFrame:
+        # patient_id and category of every patient with the sequences
+        ids, patients = self.occurrence_codes(ids)
+        return pd.DataFrame({"id": ids, "patient_id": self.patients[patients], "category": self.categories[self.patient_categories[patients]]})
+
+    def patients_with(self, sequence: str) -> pd.DataFrame:
+        # patients sharing the exact sequence
+        ids = self.lookup([sequence])
+        return self.occurrences(ids[ids >= 0]).drop(columns=["id"])
+
+    def public_sequences(self, min_patients: int = 2) -> pd.DataFrame:
+        """
+        Sequences shared by at least min_patients patients.
+
+        Args:
+        - min_patients (int): Minimal number of patients with the sequence.
+
+        Returns:
+        - pd.DataFrame: clonotype_sequence, number of patients and of categories, and number of patients in each category, sorted by patients.
+        """
+        patient_counts = np.diff(self.occurrence_offsets)
+        ids = np.flatnonzero(patient_counts >= min_patients)
+        occurrence_ids, patients = self.occurrence_codes(ids)
+
+        category_counts = np.zeros((len(ids), len(self.categories)), dtype=np.int64)
+        np.add.at(category_counts, (np.searchsorted(ids, occurrence_ids), self.patient_categories[patients]), 1)
+        public = pd.DataFrame({"id": ids, "clonotype_sequence": self.decode(ids), "patients": patient_counts[ids], "categories": (category_counts > 0).sum(axis=1)})
+        public = pd.concat([public, pd.DataFrame(category_counts, columns=list(self.categories))], axis=1)
+        return public.sort_values(by=["patients", "categories"], ascending=False, kind="stable").reset_index(drop=True)
+
+    def neighbors(self, sequence: str, max_mismatches: int = 1) -> pd.DataFrame:
+        """
+        Sequences of the same length with at most max_mismatches different positions (Hamming distance).
+
+        Args:
+        - sequence (str): Query sequence, it does not have to be in the index.
+        - max_mismatches (int): Maximal Hamming distance.
+
+        Returns:
+        - pd.DataFrame: id, clonotype_sequence, mismatches and number of patients of each neighbor, the sequence itself has 0 mismatches.
+        """
+        buckets = np.flatnonzero(self.lengths == len(sequence))
+        if not len(buckets):
+            return pd.DataFrame({"id": [], "clonotype_sequence": [], "mismatches": [], "patients": []})
+
+        query = np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)
+        mismatches = (self.bucket(buckets[0]) != query).sum(axis=1)
+        rows = np.flatnonzero(mismatches <= max_mismatches)
+        ids = rows + self.starts[buckets[0]]
+        neighbors = pd.DataFrame({"id": ids, "clonotype_sequence": self.decode(ids), "mismatches": mismatches[rows], "patients": np.diff(self.occurrence_offsets)[ids]})
+        return neighbors.sort_values(by=["mismatches", "patients"], ascending=[True, False], kind="stable").reset_index(drop=True)
+
+    def neighbor_pairs(self, max_mismatches: int = 1) -> pd.DataFrame:
+        """
+        All pairs of distinct sequences with at most max_mismatches different positions. Two sequences of the same length
+        are within the distance iff they are equal after masking some max_mismatches positions, so for every combination
+        of masked positions the sequences are grouped by a key of the other positions and pairs are taken within groups.
+        No pairwise comparison of the whole bucket is needed.
+
+        Args:
+        - max_mismatches (int): Maximal Hamming distance (at least 1).
+
+        Returns:
+        - pd.DataFrame: id_a < id_b and mismatches of each pair.
+        """
+        pairs = [np.empty(0, dtype=np.int64)]
+        for index, length in enumerate(self.lengths):
+            matrix = self.bucket(index)
+            if len(matrix) < 2:
+                continue
+            columns = matrix.astype(np.uint64)
+            bucket_pairs = []
+            for masked in combinations(range(length), min(max_mismatches, length)):
+                keys = np.zeros(len(matrix), dtype=np.uint64)
+                for column in range(length):
+                    if column not in masked:
+                        keys = keys * HASH_MULTIPLIER + columns[:, column] # uint64 arithmetic wraps around
+                bucket_pairs.append(pairs_in_groups(keys))
+            bucket_pairs = np.unique(np.concatenate(bucket_pairs))
+            # bucket rows -> sequence ids
+            row_a, row_b = bucket_pairs // (len(matrix) + 1) + self.starts[index], bucket_pairs % (len(matrix) + 1) + self.starts[index]
+            pairs.append(row_a * (len(self) + 1) + row_b)
+
+        pairs = np.concatenate(pairs)
+        id_a, id_b = pairs // (len(self) + 1), pairs % (len(self) + 1)
+        buckets = np.searchsorted(self.starts, id_a, side="right") - 1
+        mismatches = np.empty(len(pairs), dtype=np.int64)
+        for index in np.unique(buckets):
+            selected = buckets == index
+            matrix = self.bucket(index)
+            mismatches[selected] = (matrix[id_a[selected] - self.starts[index]] != matrix[id_b[selected] - self.starts[index]]).sum(axis=1)
+
+        neighbors = mismatches <= max_mismatches # pairs of colliding keys
+        return pd.DataFrame({"id_a": id_a[neighbors], "id_b": id_b[neighbors], "mismatches": mismatches[neighbors]})
+
+    def cluster(self, max_mismatches: int = 1) -> pd.DataFrame:
+        """
+        Clusters of sequences connected by pairs within max_mismatches (see neighbor_pairs).
+
+        Args:
+        - max_mismatches (int): Maximal Hamming distance of connected sequences.
+
+        Returns:
+        - pd.DataFrame: id, clonotype_sequence and cluster of each sequence with at least one neighbor.
+        """
+        if sparse is None:
+            raise ImportError("scipy is required for clustering")
+
+        pairs = self.neighbor_pairs(max_mismatches)
+        graph = sparse.coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs["id_a"], pairs["id_b"])), shape=(len(self), len(self)))
+        _, labels = connected_components(graph, directed=False)
+        ids = np.unique(np.concatenate([pairs["id_a"].to_numpy(), pairs["id_b"].to_numpy()]))
+        clusters = pd.DataFrame({"id": ids, "clonotype_sequence": self.decode(ids), "cluster": pd.factorize(labels[ids])[0]})
+        return clusters.sort_values(by=["cluster", "id"], kind="stable").reset_index(drop=True)
+
+
+def pairs_in_groups(keys: np.ndarray) -> np.ndarray:
+    # pairs (a, b), a < b, of rows with equal keys encoded as a * (len(keys) + 1) + b
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    # rows of groups with one row can not make a pair
+    grouped = np.zeros(len(keys), dtype=bool)
+    grouped[1:] |= sorted_keys[1:] == sorted_keys[:-1]
+    grouped[:-1] |= sorted_keys[1:] == sorted_keys[:-1]
+    order, sorted_keys = order[grouped], sorted_keys[grouped]
+
+    pairs = []
+    distance = 1
+    while distance < len(order):
+        same = sorted_keys[distance:] == sorted_keys[:-distance]
+        if not same.any():
+            break
+        a, b = order[:-distance][same], order[distance:][same]
+        pairs.append(np.minimum(a, b).astype(np.int64) * (len(keys) + 1) + np.maximum(a, b))
+        distance += 1
+    return np.concatenate(pairs) if pairs else np.empty(0, dtype=np.int64)
+
+
+def build_similarity_index(data_df: pd.DataFrame) -> SimilarityIndex:
+    """
+    Build the similarity index of a dataset.
+
+    Args:
+    - data_df (pd.DataFrame): Dataset with patient_id, clonotype_sequence and category columns (e.g. VJ_INDEPENDENT).
+
+    Returns:
+    - SimilarityIndex: Index of the distinct sequences of the dataset.
+    """
+    data_df = data_df[data_df["clonotype_sequence"].notna().to_numpy()]
+    sequence_codes, sequences = pd.factorize(data_df["clonotype_sequence"])
+    sequences = pd.Series(np.asarray(sequences, dtype=object))
+    lengths = sequences.str.len().to_numpy()
+
+    # sequence ids follow the order by length and sequence
+    order = pd.DataFrame({"length": lengths, "sequence": sequences}).sort_values(by=["length", "sequence"]).index.to_numpy()
+    ids = np.empty(len(order), dtype=np.int64)
+    ids[order] = np.arange(len(order))
+    sorted_lengths = lengths[order]
+
+    chars = np.frombuffer("".join(sequences.to_numpy()[order]).encode("ascii"), dtype=np.uint8).copy()
+    bucket_lengths = np.unique(sorted_lengths)
+    starts = np.append(np.searchsorted(sorted_lengths, bucket_lengths), len(order))
+    offsets = np.concatenate([[0], np.cumsum(np.diff(starts) * bucket_lengths)])[:-1]
+
+    patient_codes, patients = pd.factorize(data_df["patient_id"], sort=True)
+    category_codes, categories = pd.factorize(data_df["category"], sort=True)
+    patient_categories = np.zeros(len(patients), dtype=np.int64)
+    patient_categories[patient_codes] = category_codes
+
+    occurrences = np.unique(ids[sequence_codes] * len(patients) + patient_codes) # distinct (sequence, patient) pairs sorted by sequence
+    occurrence_offsets = np.searchsorted(occurrences // len(patients), np.arange(len(order) + 1))
+
+    return SimilarityIndex(chars, bucket_lengths, starts, offsets, occurrence_offsets, (occurrences % len(patients)).astype(np.int32),
+                           np.asarray(patients, dtype=str), patient_categories, np.asarray(categories, dtype=str))
+
+
+def load_similarity_index(NAME: str = "VJ_INDEPENDENT", path: str = SIMILARITY_PATH) -> SimilarityIndex:
+    """
+    Load the persisted similarity index. It is built from the dataset and saved if it does not exist or the dataset is newer.
+
+    Args:
+    - NAME (str): Name of the dataset the index is built from (see load_tcr_data).
+    - path (str): Path of the index file.
+
+    Returns:
+    - SimilarityIndex: Loaded index.
+    """
+    file_path = data_sources[NAME][0]
+    dataset_files = [file for file in (file_path, columnar_path(file_path)) if os.path.exists(file)]
+    if os.path.exists(path) and all(os.path.getmtime(file) <= os.path.getmtime(path) for file in dataset_files):
+        return SimilarityIndex.load(path)
+
+    index = build_similarity_index(load_tcr_data(NAME, columns=["patient_id", "clonotype_sequence", "category"], categorical=False))
+    index.save(path)
+    print(f"Similarity index built. Sequences: {len(index)}")
+    return index
@@ -1,55 +1,214 @@
+import os
+import json
+import argparse
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
+CHUNK_SIZE = 1_000_000 # rows checked at once
+MAX_REPORTED_ROWS = 100 # row indices kept for each check (0 = all), all offending rows are counted
+WORKERS = os.cpu_count() # datasets checked in parallel, 1 = check in this process
 
-def check_duplicates(df: pd.DataFrame) -> bool:
-    # Check for duplicates in the dataframe
-    return df.duplicated().any()
-
-def check_missing_values(df: pd.DataFrame) -> bool:
-    # Check for missing values in the dataframe
-    return df.isnull().values.any()
-
-def check_for_anomalies(df: pd.DataFrame) -> bool:
-    # Check for anomalies in the dataframe
-    if "Unknown" in df["category"].unique():
-        return True
-    return False
-
-def check_V_region(df: pd.DataFrame) -> bool:
-    # Check for anomalies in the V region
-    if "V_region" not in df.columns:
-        return False
-    # Start with the V and second one is number
-    return not df["V_region"].str.match(r"V\d+").all()
-
-def check_J_region(df: pd.DataFrame) -> bool:
-    # Check for anomalies in the J region
-    if "J_region" not in df.columns:
-        return False
-    # Start with the J and second one is number
-    return not df["J_region"].str.match(r"J\d+").all()
-
-def check_integrity(df: pd.DataFrame) -> bool:
-    print("Checking for duplicates..." if check_duplicates(df) else "No duplicates found.")
-    print("Checking for missing values..." if check_missing_values(df) else "No missing values found.")
-    print("Checking for anomalies..." if check_for_anomalies(df) else "No anomalies found.")
-    print("Checking for anomalies in V region..." if check_V_region(df) else "No anomalies found in V region.")
-    print("Checking for anomalies in J region..." if check_J_region(df) else "No anomalies found in J region.")
+CHECKS = {
+    "duplicates": "Duplicate rows (later occurrences)",
+    "missing_values": "Rows with missing values",
+    "unknown_category": "Rows with category Unknown (patient missing in the vial codes)",
+    "invalid_category": "Rows with a category that is not allowed",
+    "mixed_category": "Rows with another category than the first row of the patient",
+    "invalid_V_region": "Rows with V_region not matching V<number>",
+    "invalid_J_region": "Rows with J_region not matching J<number>",
+    "invalid_sequence": "Rows with clonotype_sequence not starting with C and ending with F",
+    "invalid_count": "Rows with specific_seq_count below 1",
+    "invalid_ratio": "Rows with ratio outside of (0, 1]",
+    "unsorted_patients": "First rows of patients whose rows are not stored together",
+}
+
+
+def invalid_values(column: pd.Series, predicate) -> np.ndarray:
+    # mask of present values failing the predicate, for categoricals the predicate is evaluated once for each distinct value
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        invalid = ~np.asarray(predicate(pd.Series(column.cat.categories.astype(str))), dtype=bool)
+        return np.append(invalid, False)[column.cat.codes.to_numpy()] # code -1 (missing) -> False
+    return column.notna().to_numpy() & ~np.asarray(predicate(column).fillna(True), dtype=bool)
+
+
+class DatasetValidator:
+    """
+    Streaming integrity checks of one dataset, chunks are checked as they are read (see update).
+    Duplicates are found by 64-bit hashes of rows. Rows of a patient are stored together (make_dataset sorts by patient_id),
+    so only hashes of the last patient are kept between chunks and memory depends on the chunk size and the largest patient.
+    Patients whose rows are not stored together are reported by unsorted_patients, their duplicates may be missed.
+    """
+    def __init__(self, categories: list = None, max_rows: int = MAX_REPORTED_ROWS):
+        """
+        Args:
+        - categories (list): Allowed categories, categories are not checked if None.
+        - max_rows (int): Number of row indices kept for each check, 0 keeps all of them.
+        """
+        self.categories = None if categories is None else list(categories)
+        self.max_rows = max_rows
+        self.rows = 0
+        self.counts = {check: 0 for check in CHECKS}
+        self.row_indices = {check: [] for check in CHECKS}
+
+        self.patients = set() # patients seen so far
+        self.last_patient = None # patient of the last row, its rows may continue in the next chunk
+        self.last_category = None
+        self.last_digests = np.array([], dtype=np.uint64) # hashes of rows of the last patient
+
+    def add(self, check: str, mask: np.ndarray, index: np.ndarray) -> None:
+        # count offending rows of a chunk and keep the first row indices
+        offending = index[mask]
+        self.counts[check] += len(offending)
+        missing = self.max_rows - len(self.row_indices[check]) if self.max_rows else len(offending)
+        if missing > 0:
+            self.row_indices[check].extend(int(row) for row in offending[:missing])
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        """
+        Check a chunk of the dataset.
+
+        Args:
+        - chunk (pd.DataFrame): Next rows of the dataset, index is the row number in the dataset (see iter_tcr_data).
+        """
+        if not len(chunk):
+            return
+        index = chunk.index.to_numpy()
+        self.rows += len(chunk)
+
+        # runs of rows of one patient, the first run continues the last patient of the previous chunk
+        patient_codes, patient_ids = pd.factorize(chunk["patient_id"], use_na_sentinel=False)
+        starts = np.flatnonzero(np.r_[True, patient_codes[1:] != patient_codes[:-1]])
+        run_patients = np.asarray(patient_ids, dtype=object)[patient_codes[starts]]
+        continued = run_patients[0] == self.last_patient
+        new_runs = np.ones(len(starts), dtype=bool)
+        new_runs[0] = not continued
+        unsorted = new_runs & (pd.Series(run_patients).isin(self.patients).to_numpy() | pd.Series(run_patients).duplicated().to_numpy())
+        self.add("unsorted_patients", unsorted, index[starts])
+        self.patients.update(run_patients)
+
+        # a duplicate row has the hash of an earlier row of its patient
+        digests = pd.util.hash_pandas_object(chunk, index=False, categorize=False).to_numpy() # sequences are mostly distinct, factorizing them first is slower
+        combined = np.concatenate([self.last_digests, digests])
+        self.add("duplicates", pd.Series(combined).duplicated().to_numpy()[len(self.last_digests):], index)
+        self.last_digests = combined if len(starts) == 1 and continued else digests[starts[-1]:]
+        self.last_patient = run_patients[-1]
+
+        self.add("missing_values", chunk.isna().any(axis=1).to_numpy(), index)
+
+        if "category" in chunk.columns:
+            category_codes, categories = pd.factorize(chunk["category"], use_na_sentinel=False)
+            categories = pd.Series(np.asarray(categories, dtype=object))
+            self.add("unknown_category", (categories == "Unknown").to_numpy()[category_codes], index)
+            if self.categories is not None:
+                self.add("invalid_category", (~categories.isin(self.categories)).to_numpy()[category_codes], index)
+
+            # every row of a patient has the category of its first row
+            run_ids = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(chunk)]))
+            first_codes = category_codes[starts]
+            if continued:
+                previous = np.flatnonzero(categories.to_numpy() == self.last_category)
+                first_codes[0] = previous[0] if len(previous) else -1 # category of the patient is not in this chunk
+            self.add("mixed_category", category_codes != first_codes[run_ids], index)
+            if len(starts) > 1 or not continued:
+                self.last_category = categories[category_codes[starts[-1]]]
+
+        if "V_region" in chunk.columns:
+            self.add("invalid_V_region", invalid_values(chunk["V_region"], lambda values: values.str.match(r"V\d+")), index)
+        if "J_region" in chunk.columns:
+            self.add("invalid_J_region", invalid_values(chunk["J_region"], lambda values: values.str.match(r"J\d+")), index)
+        if "clonotype_sequence" in chunk.columns:
+            self.add("invalid_sequence", invalid_values(chunk["clonotype_sequence"], lambda values: values.str.startswith("C") & values.str.endswith("F")), index)
+        if "specific_seq_count" in chunk.columns:
+            self.add("invalid_count", (chunk["specific_seq_count"] < 1).to_numpy(), index)
+        if "ratio" in chunk.columns:
+            self.add("invalid_ratio", ((chunk["ratio"] <= 0) | (chunk["ratio"] > 1)).to_numpy(), index)
+
+    def report(self) -> dict:
+        # number of checked rows, number and first row indices of offending rows of each check that failed
+        return {"rows": self.rows, "failed": {check: {"count": count, "rows": self.row_indices[check]}
+                                              for check, count in self.counts.items() if count}}
+
+
+def check_dataset(NAME: str, chunksize: int = CHUNK_SIZE, categories: list = None, max_rows: int = MAX_REPORTED_ROWS) -> dict:
+    """
+    Check integrity of a dataset chunk by chunk (see DatasetValidator).
+
+    Args:
+    - NAME (str): Name of the dataset (see tcr_info).
+    - chunksize (int): Number of rows checked at once.
+    - categories (list): Allowed categories, categories are not checked if None.
+    - max_rows (int): Number of row indices reported for each check, 0 reports all of them.
+
+    Returns:
+    - dict: Report of the dataset (see DatasetValidator.report).
+    """
+    validator = DatasetValidator(categories, max_rows)
+    for chunk in TCR_load.iter_tcr_data(NAME, chunksize=chunksize):
+        validator.update(chunk)
+    return validator.report()
+
+def check_datasets(names: list = None, chunksize: int = CHUNK_SIZE, categories: list = None, workers: int = WORKERS,
+                   max_rows: int = MAX_REPORTED_ROWS) -> dict:
+    """
+    Check integrity of datasets, each dataset is checked in its own process.
+
+    Args:
+    - names (list): Names of the datasets, all exported datasets if None.
+    - chunksize (int): Number of rows checked at once.
+    - categories (list): Allowed categories, categories are not checked if None.
+    - workers (int): Number of processes, 1 checks the datasets in this process.
+    - max_rows (int): Number of row indices reported for each check, 0 reports all of them.
+
+    Returns:
+    - dict: Dataset name -> report (see DatasetValidator.report).
+    """
+    if names is None:
+        names = [NAME for NAME, (file_path, _) in TCR_load.data_sources.items()
+                 if os.path.exists(file_path) or os.path.exists(TCR_load.columnar_path(file_path))]
+    if not names:
+        return {}
+
+    workers = min(workers or 1, len(names))
+    if workers == 1:
+        reports = [check_dataset(NAME, chunksize, categories, max_rows) for NAME in names]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            reports = list(executor.map(check_dataset, names, repeat(chunksize), repeat(categories), repeat(max_rows)))
+    return dict(zip(names, reports))
+
+def print_report(reports: dict) -> bool:
+    # print failed checks of each dataset, returns whether all checks passed
+    for NAME, report in reports.items():
+        print(f"{NAME}: {report['rows']} rows checked" + ("" if report["failed"] else ", no problems found."))
+        for check, failed in report["failed"].items():
+            rows = ", ".join(str(row) for row in failed["rows"]) + (", ..." if failed["count"] > len(failed["rows"]) else "")
+            print(f"    {CHECKS[check]}: {failed['count']} (rows {rows})")
     print("-"*100)
+    return not any(report["failed"] for report in reports.values())
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check integrity of the exported TCR datasets.")
+    parser.add_argument("--datasets", nargs="*", help="names of the datasets (see tcr_info), all exported datasets if not given")
+    parser.add_argument("--categories", nargs="*", help="allowed categories, not checked if not given")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="rows checked at once")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="datasets checked in parallel")
+    parser.add_argument("--max-rows", type=int, default=MAX_REPORTED_ROWS, help="row indices reported for each check, 0 = all")
+    parser.add_argument("--output", help="JSON file with the report")
+    args = parser.parse_args()
 
-def start_integrity_check() -> None:
-    for name in TCR_load.data_sources:
-        print(f"Loading {name} data...")
-        df = TCR_load.load_tcr_data(name)
-        check_integrity(df)
+    reports = check_datasets(args.datasets, args.chunk_size, args.categories, args.workers, args.max_rows)
+    passed = print_report(reports)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(reports, file, indent=2)
+    raise SystemExit(0 if passed else 1)
 
 
 if __name__ == "__main__":
-    import TCR_load
-    TCR_load.Integrity = True
-    start_integrity_check()
+    import TCR_load # run from the repository root: python TCR_DATASETS/integrity.py
+    main()
 
 else:
     import TCR_DATASETS.TCR_load as TCR_load
-    TCR_load.Integrity = True
@@ -0,0 +1,197 @@
+import pandas as pd
+import os
+import json
+import pickle
+import hashlib
+from contextlib import contextmanager
+from typing import Iterator
+
+try:
+    import pyarrow as pa
+except ImportError: # without pyarrow values are pickled
+    pa = None
+
+CACHE_DIR = "backup/cache"
+MAX_CACHE_SIZE = 20 * 1024**3 # bytes, least recently used entries are removed above this size
+
+
+def fingerprint_data(df: pd.DataFrame) -> str:
+    """
+    Fingerprint of the content of a dataframe. Values are hashed row by row, index and dtypes are ignored,
+    so the same data loaded from CSV (strings) and Parquet (categoricals) has the same fingerprint.
+
+    Args:
+    - df (pd.DataFrame): Input dataframe.
+
+    Returns:
+    - str: Hex digest of the columns and values.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([str(column) for column in df.columns]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def fingerprint_file(path: str) -> str:
+    # Fingerprint of a file from its path, size and modification time - reading GBs of the productive table is too slow
+    stat = os.stat(path)
+    return hashlib.blake2b(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode(), digest_size=16).hexdigest()
+
+def make_key(name: str, *fingerprints: str, **params) -> str:
+    """
+    Make a cache key from fingerprints of the inputs and parameters of the computation.
+
+    Args:
+    - name (str): Name of the cached value, used as prefix of the file name.
+    - fingerprints (str): Fingerprints of the inputs (see fingerprint_data, fingerprint_file).
+    - params: Parameters of the computation, must be JSON serializable.
+
+    Returns:
+    - str: Cache key.
+    """
+    digest = hashlib.blake2b(json.dumps([fingerprints, params], sort_keys=True, default=str).encode(), digest_size=16)
+    return f"{name}_{digest.hexdigest()}"
+
+
+class Cache:
+    """
+    Content-addressed cache of dataframes (or dictionaries of dataframes) on disk.
+    Values are stored as Arrow IPC files (pickle without pyarrow), written atomically and evicted
+    least recently used first when the cache grows over max_size.
+    """
+    def __init__(self, directory: str = CACHE_DIR, max_size: int = MAX_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + (".arrow" if pa is not None else ".pkl"))
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def get(self, key: str):
+        """
+        Load a cached value.
+
+        Args:
+        - key (str): Cache key (see make_key).
+
+        Returns:
+        - pd.DataFrame | dict | None: Cached value, None if the key is not cached.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path) # mark as recently used
+
+        if pa is None:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+
+        with pa.memory_map(path, "r") as source:
+            table = pa.ipc.open_file(source).read_all()
+        value = table.to_pandas()
+        if table.schema.metadata and table.schema.metadata.get(b"tcr_cache") == b"dict":
+            # dictionary of dataframes was stored as one table with the keys in __key__ column
+            return {key: df.drop(columns="__key__").reset_index(drop=True) for key, df in value.groupby("__key__", sort=False)}
+        return value
+
+    def iter_batches(self, key: str) -> Iterator[pd.DataFrame]:
+        # Yield a cached dataframe in parts as it was written, without loading it at once
+        path = self.path(key)
+        os.utime(path)
+        if pa is None:
+            yield self.get(key)
+            return
+        with pa.memory_map(path, "r") as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).to_pandas()
+
+    def put(self, key: str, value) -> None:
+        """
+        Store a value in the cache.
+
+        Args:
+        - key (str): Cache key (see make_key).
+        - value (pd.DataFrame | dict): Dataframe or dictionary of dataframes with the same columns.
+        """
+        with self.writer(key, kind="dict" if isinstance(value, dict) else "frame") as write:
+            if isinstance(value, dict):
+                if not value:
+                    write(pd.DataFrame({"__key__": pd.Series(dtype=str)}))
+                for value_key, df in value.items():
+                    write(df.assign(__key__=value_key))
+            else:
+                write(value)
+
+    @contextmanager
+    def writer(self, key: str, kind: str = "frame"):
+        """
+        Write a dataframe to the cache in parts. The entry appears only after all parts are written.
+
+        Args:
+        - key (str): Cache key (see make_key).
+        - kind (str): "frame" or "dict" (see put).
+
+        Returns:
+        - function: Call it with each part of the dataframe.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        parts: list = []
+        state: dict = {"writer": None, "sink": None, "schema": None}
+
+        def write(df: pd.DataFrame) -> None:
+            if pa is None:
+                parts.append(df)
+                return
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            # dictionaries can not change between parts of an IPC file, categoricals are stored as plain values
+            table = table.cast(pa.schema([pa.field(field.name, field.type.value_type) if pa.types.is_dictionary(field.type) else field for field in table.schema],
+                                         metadata=table.schema.metadata))
+            if state["writer"] is None:
+                state["schema"] = table.schema.with_metadata({**(table.schema.metadata or {}), b"tcr_cache": kind.encode()})
+                state["sink"] = pa.OSFile(temporary_path, "wb")
+                state["writer"] = pa.ipc.new_file(state["sink"], state["schema"])
+            state["writer"].write_table(table.cast(state["schema"])) # parts must have the schema of the first part
+
+        try:
+            yield write
+            if pa is None:
+                value = parts[0] if kind == "frame" and len(parts) == 1 else pd.concat(parts, ignore_index=True)
+                if kind == "dict":
+                    value = {key: df.drop(columns="__key__").reset_index(drop=True) for key, df in value.groupby("__key__", sort=False)}
+                with open(temporary_path, "wb") as f:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            elif state["writer"] is not None:
+                state["writer"].close()
+                state["sink"].close()
+            else:
+                return # nothing was written
+            os.replace(temporary_path, path) # atomic - readers never see a half written entry
+        finally:
+            if state["sink"] is not None and not state["sink"].closed:
+                state["sink"].close()
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+        self.evict(keep=key)
+
+    def evict(self, keep: str = None) -> None:
+        # Remove least recently used entries until the cache is smaller than max_size
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith((".arrow", ".pkl")) and os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            if keep is not None and path == self.path(keep):
+                continue
+            os.remove(path)
+            size -= entry_size
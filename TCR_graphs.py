@@ -8,61 +8,143 @@ import plotly.graph_objects as go
 with warnings.catch_warnings():
     warnings.simplefilter("ignore")
 
-from TCR_DATASETS.TCR_load import load_tcr_data
+from TCR_DATASETS.TCR_load import load_tcr_data, make_vj_region
+from TCR_DATASETS.TCR_diversity import STATISTICS as DIVERSITY_STATISTICS, load_diversity
 
 from typing import Literal
 from itertools import product
 import os
-import tqdm
-import pickle
 
-from deepdiff import DeepDiff
+from TCR_cache import Cache, fingerprint_data, make_key
+from TCR_render import PlotRenderer
+from TCR_profile import PROFILER, progress, stage
 
-def make_category_dataframes(region_column: str, data_df: pd.DataFrame, type: str) -> dict:
+def aggregate_categories(region_column: str, data_df: pd.DataFrame) -> dict:
     """
-    Create dataframes for each category in the dataset based on a specific region column and type of analysis.
-    The resulting dataframes are either loaded from a pickle file or generated and saved to a pickle file.
+    Sum ratio and specific_seq_count of each region in each category with one groupby.
+    Categories and regions keep the order of their first occurrence in the dataset.
 
     Args:
     - region_column (str): The column name for regions in the dataset.
     - data_df (pd.DataFrame): The input dataframe containing TCR data.
-    - type (str): The type of analysis to perform ('frequency' or 'sum').
 
     Returns:
-    - dict: A dictionary of dataframes for each category.
+    - dict: Type of analysis ('frequency' or 'sum') -> dictionary of dataframes for each category.
+    """
+    grouped: pd.DataFrame = data_df.groupby(["category", region_column], sort=False, observed=True)[list(ANALYSIS_OUTPUT_COLUMNS.values())].sum().reset_index()
+
+    category_dfs: dict = {type: {} for type in ANALYSIS_OUTPUT_COLUMNS}
+    for category, category_df in grouped.groupby("category", sort=False, observed=True):
+        for type, output_column in ANALYSIS_OUTPUT_COLUMNS.items():
+            category_dfs[type][category] = pd.DataFrame({region_column: category_df[region_column].to_numpy(), "output": category_df[output_column].to_numpy()})
+
+    return category_dfs
+
+
+def make_all_category_dataframes(region_column: str, data_df: pd.DataFrame) -> dict:
+    """
+    Create dataframes for each category in the dataset based on a specific region column for all types of analysis.
+    The resulting dataframes are cached under a fingerprint of the input data, so they are generated again after the dataset changes.
+
+    Args:
+    - region_column (str): The column name for regions in the dataset.
+    - data_df (pd.DataFrame): The input dataframe containing TCR data.
+
+    Returns:
+    - dict: Type of analysis ('frequency' or 'sum') -> dictionary of dataframes for each category.
+    """
+    with stage("make_category_dataframes", len(data_df)) as record:
+        keys = category_dataframes_keys(region_column, data_df)
+        all_category_dfs = {analysis_type: CACHE.get(key) for analysis_type, key in keys.items()}
+        if any(category_dfs is None for category_dfs in all_category_dfs.values()):
+            # Generate the category dataframes for all types of analysis and cache them
+            all_category_dfs = aggregate_categories(region_column, data_df)
+            for analysis_type, analysis_dfs in all_category_dfs.items():
+                CACHE.put(keys[analysis_type], analysis_dfs)
+        record["rows_out"] = sum(len(category_df) for category_dfs in all_category_dfs.values() for category_df in category_dfs.values())
+
+    return all_category_dfs
+
+
+def category_dataframes_keys(region_column: str, data_df: pd.DataFrame) -> dict:
+    # Cache keys of the category dataframes of data_df for each type of analysis, only columns used by aggregate_categories are fingerprinted
+    fingerprint = fingerprint_data(data_df[["category", region_column] + list(ANALYSIS_OUTPUT_COLUMNS.values())])
+    return {analysis_type: make_key("category_dfs", fingerprint, region_column=region_column, type=analysis_type) for analysis_type in ANALYSIS_OUTPUT_COLUMNS}
+
+
+def update_category_dataframes(region_column: str, old_data_df: pd.DataFrame, new_data_df: pd.DataFrame,
+                               removed_df: pd.DataFrame, added_df: pd.DataFrame) -> dict:
     """
+    Update cached category dataframes of old_data_df after its rows were replaced (see update_datasets in TCR_make_dataset)
+    and cache them for new_data_df. Only removed and added rows are aggregated, not the whole dataset.
+    Regions without any specific_seq_count left are dropped, new regions are appended after the existing ones.
+    If the category dataframes of old_data_df are not cached, they are made from new_data_df.
 
-    # Check if the category dataframes already exist in a pickle file
-    if os.path.exists(f"backup/category_dfs_{region_column}_{type}.pkl"):
-        with open(f"backup/category_dfs_{region_column}_{type}.pkl", "rb") as f:
-            category_dfs: dict = pickle.load(f)
-            
-    else:
-        # Generate the category dataframes if not found in the pickle file
-        categories: np.ndarray = data_df["category"].unique() # Get all categories in the dataset
-        category_dfs: dict = {}
+    Args:
+    - region_column (str): The column name for regions in the dataset.
+    - old_data_df (pd.DataFrame): Dataset before the update.
+    - new_data_df (pd.DataFrame): Dataset after the update.
+    - removed_df (pd.DataFrame): Rows of old_data_df that are not in new_data_df.
+    - added_df (pd.DataFrame): Rows of new_data_df that are not in old_data_df.
+
+    Returns:
+    - dict: Type of analysis ('frequency' or 'sum') -> dictionary of dataframes for each category.
+    """
+    old_keys = category_dataframes_keys(region_column, old_data_df)
+    all_category_dfs = {analysis_type: CACHE.get(key) for analysis_type, key in old_keys.items()}
+    if any(category_dfs is None for category_dfs in all_category_dfs.values()):
+        return make_all_category_dataframes(region_column, new_data_df)
+
+    removed_dfs = aggregate_categories(region_column, removed_df)
+    added_dfs = aggregate_categories(region_column, added_df)
+
+    merged: dict = {}
+    for analysis_type in ANALYSIS_OUTPUT_COLUMNS:
+        merged[analysis_type] = {}
+        categories = list(all_category_dfs[analysis_type]) + [category for category in added_dfs[analysis_type] if category not in all_category_dfs[analysis_type]]
         for category in categories:
-            category_df: pd.DataFrame = data_df[data_df["category"] == category] # Get the dataframe for the current category
-            category_regions: np.ndarray = category_df[region_column].unique() # Get all regions in the current category
-            category_regions_freq: list = []
-            for region in category_regions:
-                region_df: pd.DataFrame = category_df[category_df[region_column] == region] # Get the dataframe for the current region
+            parts = [all_category_dfs[analysis_type].get(category), added_dfs[analysis_type].get(category)]
+            if category in removed_dfs[analysis_type]:
+                parts.append(removed_dfs[analysis_type][category].assign(output=-removed_dfs[analysis_type][category]["output"]))
+            category_df = pd.concat([part for part in parts if part is not None], ignore_index=True)
+            merged[analysis_type][category] = category_df.groupby(region_column, sort=False, observed=True)["output"].sum().reset_index()
 
-                if type == "frequency": region_frequence_for_all_sequences = np.sum(region_df["ratio"]) # Calculate the frequency of the region for all sequences
-                elif type == "sum": region_frequence_for_all_sequences = np.sum(region_df["specific_seq_count"]) # Calculate the sum of the region for all sequences
+    # specific_seq_count of a region is positive while any of its rows is left, ratio sums are not exact after subtraction
+    for category, sum_df in merged["sum"].items():
+        present = (sum_df["output"] > 0).to_numpy()
+        for analysis_type in ANALYSIS_OUTPUT_COLUMNS:
+            merged[analysis_type][category] = merged[analysis_type][category][present].reset_index(drop=True)
+    for analysis_type in ANALYSIS_OUTPUT_COLUMNS:
+        merged[analysis_type] = {category: category_df for category, category_df in merged[analysis_type].items() if len(category_df)}
 
-                category_regions_freq.append(region_frequence_for_all_sequences)
+    for analysis_type, key in category_dataframes_keys(region_column, new_data_df).items():
+        CACHE.put(key, merged[analysis_type])
+    return merged
 
-            category_dfs[category] = pd.DataFrame({region_column: category_regions, "output": category_regions_freq})
-        
-        # Save the generated dataframes to a pickle file
-        with open(f"backup/category_dfs_{region_column}_{type}.pkl", "wb") as f:
-            pickle.dump(category_dfs, f)
 
-    return category_dfs
+def make_category_dataframes(region_column: str, data_df: pd.DataFrame, type: str) -> dict:
+    """
+    Create dataframes for each category in the dataset based on a specific region column and type of analysis.
+    The dataframes are cached, see make_all_category_dataframes.
+
+    Args:
+    - region_column (str): The column name for regions in the dataset.
+    - data_df (pd.DataFrame): The input dataframe containing TCR data.
+    - type (str): The type of analysis to perform ('frequency' or 'sum').
 
+    Returns:
+    - dict: A dictionary of dataframes for each category.
+    """
+    return make_all_category_dataframes(region_column, data_df)[type]
+
+
+def export_plot(fig, path: str, renderer: PlotRenderer = None) -> None:
+    # Export the plot now, or queue it to the renderer (exported in parallel by renderer.render())
+    if renderer is None: fig.write_image(path)
+    else: renderer.add(fig, path)
 
-def make_full_plot(show, save, frequecy_dfs, categories, region_column, top, type, add_annotations_to_unique_regions = True):
+
+def make_full_plot(show, save, frequecy_dfs, categories, region_column, top, type, add_annotations_to_unique_regions = True, renderer = None):
     """
     Create a full plot for all categories combined, displaying the top regions based on the specified type of analysis.
 
@@ -74,6 +156,7 @@ def make_full_plot(show, save, frequecy_dfs, categories, region_column, top, typ
     - region_column (str): The column name for regions in the dataset.
     - top (int): Number of top regions to display.
     - type (str): The type of analysis to perform ('frequency' or 'sum').
+    - renderer (PlotRenderer): Queue saved plots to the renderer instead of exporting them now.
     """
     fig = go.Figure()
     for category in categories:
@@ -96,13 +179,13 @@ def make_full_plot(show, save, frequecy_dfs, categories, region_column, top, typ
 
 
 
-    if save: fig.write_image(f"{path}/{region_column}_frequency_ALL_GROUP_{top}.png")
+    if save: export_plot(fig, f"{path}/{region_column}_frequency_ALL_GROUP_{top}.png", renderer)
     if show: fig.show()
     fig.update_layout(barmode='stack')
-    if save: fig.write_image(f"{path}/{region_column}_frequency_ALL_STACK_{top}.png")
+    if save: export_plot(fig, f"{path}/{region_column}_frequency_ALL_STACK_{top}.png", renderer)
     if show: fig.show()
 
-def make_plot_for_each_category(show, save, frequecy_dfs, categories, region_column, top, type):
+def make_plot_for_each_category(show, save, frequecy_dfs, categories, region_column, top, type, renderer = None):
     """
     Create individual plots for each category, displaying the top regions based on the specified type of analysis.
 
@@ -114,6 +197,7 @@ def make_plot_for_each_category(show, save, frequecy_dfs, categories, region_col
     - region_column (str): The column name for regions in the dataset.
     - top (int): Number of top regions to display.
     - type (str): The type of analysis to perform ('frequency' or 'sum').
+    - renderer (PlotRenderer): Queue saved plots to the renderer instead of exporting them now.
     """
     path = f"Analysis/{type}_TOP_{top}_{region_column}"
     for category in categories:
@@ -137,50 +221,60 @@ def make_plot_for_each_category(show, save, frequecy_dfs, categories, region_col
                     font=dict(family="Courier New, monospace", size=16,color="red"))
                 
         if show: fig.show()
-        if save: fig.write_image(f"{path}/{region_column}_frequency_{category}_{top}.png")
+        if save: export_plot(fig, f"{path}/{region_column}_frequency_{category}_{top}.png", renderer)
 
-def Make_analysis(data_df: pd.DataFrame, region_column, type_of_analysis, save_plot = False, show_plot = False, regions_count = 10):
+def rank_regions(data_df: pd.DataFrame, region_column) -> dict:
     """
-    Perform analysis on the provided TCR data, creating and saving plots for the specified region column and type of analysis.
+    Aggregate and sort regions of each category once for all types of analysis. Top N regions of any
+    regions_count are then just the first N rows (see plot_top_regions).
 
     Args:
     - data_df (pd.DataFrame): The input dataframe containing TCR data.
     - region_column (str): The column name for regions in the dataset.
-    - type_of_analysis (str): The type of analysis to perform ('frequency' or 'sum').
-    - save_plot (bool): Whether to save the plots.
-    - show_plot (bool): Whether to display the plots.
-    - regions_count (int): Number of top regions to include in the analysis.
-    """     
-    categories: np.ndarray = data_df["category"].unique()
 
+    Returns:
+    - dict: Type of analysis -> dictionary of dataframes for each category, sorted by output normalized by the number of patients.
+    """
     # Count the number of patients in each category
-    patients_count = [len(data_df[data_df["category"] == category]["patient_id"].unique()) for category in categories]
+    patients_counts_dict = data_df.groupby("category", sort=False, observed=True)["patient_id"].nunique().to_dict()
 
     # Count the number of sequences in each category can be used for normalization too
-    # patients_count = [len(data_df[data_df["category"] == category]) for category in categories]
-
-    patients_counts_dict = dict(zip(data_df["category"].unique(), patients_count))
-    category_dfs = make_category_dataframes(region_column=region_column, data_df=data_df, type=type_of_analysis)
-    """
-    code: print(category_dfs[categories[0]].head(10))
-    Example of category_dfs[categories[0]].head(10) output:
-            VJ_region    output
-        0  V10-1_J2-7  0.048718
-        1  V10-1_J1-1  0.113048
-        2  V10-1_J1-4  0.004329
-        3  V10-1_J1-5  0.019606
-        4  V10-1_J1-2  0.019730
-        5  V10-1_J1-6  0.009741
-        6  V10-1_J1-3  0.007991
-        7  V10-1_J2-3  0.001031
-        8  V10-1_J2-2  0.001592
-        9  V10-2_J1-4  0.008143
+    # patients_counts_dict = data_df.groupby("category", sort=False, observed=True).size().to_dict()
+
+    ranked_dfs: dict = {}
+    for type_of_analysis, category_dfs in make_all_category_dataframes(region_column, data_df).items():
+        """
+        Example of category_dfs[categories[0]].head(10) output:
+                VJ_region    output
+            0  V10-1_J2-7  0.048718
+            1  V10-1_J1-1  0.113048
+            2  V10-1_J1-4  0.004329
+            ...
+        """
+        ranked_dfs[type_of_analysis] = {}
+        for category, category_df in category_dfs.items():
+            # Normalize the output by the number of patients in each category
+            category_df = category_df.sort_values(by="output", ascending=False)
+            category_df["output"] = category_df["output"] / patients_counts_dict[category]
+            ranked_dfs[type_of_analysis][category] = category_df
+
+    return ranked_dfs
+
+def plot_top_regions(ranked_dfs: dict, region_column, type_of_analysis, save_plot = False, show_plot = False, regions_count = 10, renderer = None):
     """
-    
-    # Normalize the output by the number of patients in each category
-    for category in categories:
-        category_dfs[category] = category_dfs[category].sort_values(by="output", ascending=False).head(regions_count)
-        category_dfs[category]["output"] /= patients_counts_dict[category]
+    Create and save plots of the top regions from regions ranked by rank_regions.
+
+    Args:
+    - ranked_dfs (dict): Dictionary of sorted dataframes for each category for one type of analysis (see rank_regions).
+    - region_column (str): The column name for regions in the dataset.
+    - type_of_analysis (str): The type of analysis to perform ('frequency' or 'sum').
+    - save_plot (bool): Whether to save the plots.
+    - show_plot (bool): Whether to display the plots.
+    - regions_count (int): Number of top regions to include in the analysis.
+    - renderer (PlotRenderer): Queue saved plots to the renderer instead of exporting them now.
+    """
+    categories: list = list(ranked_dfs.keys())
+    category_dfs = {category: ranked_dfs[category].head(regions_count).copy() for category in categories}
 
     # Identify names of the regions for each category
     regions = { category: category_dfs[category][region_column].unique() for category in categories }
@@ -191,22 +285,56 @@ def Make_analysis(data_df: pd.DataFrame, region_column, type_of_analysis, save_p
         other_regions = np.concatenate([regions[other_category] for other_category in categories if category != other_category])
         unique_regions[category] = np.setdiff1d(regions[category], other_regions) # Get unique regions for the current category
 
-
-
     # Mark unique regions in the dataframes
     for category in categories:
-        category_dfs[category]["unique"] = category_dfs[category][region_column].apply(lambda x: x in unique_regions[category]) # Mark unique regions in the dataframes
-
+        category_dfs[category]["unique"] = category_dfs[category][region_column].isin(unique_regions[category]) # Mark unique regions in the dataframes
 
     # Generate and save/display plots
-    make_full_plot(show_plot, save_plot, category_dfs, categories, region_column, regions_count, type_of_analysis)
-    make_plot_for_each_category(show_plot, save_plot, category_dfs, categories, region_column, regions_count, type_of_analysis)
+    make_full_plot(show_plot, save_plot, category_dfs, categories, region_column, regions_count, type_of_analysis, renderer=renderer)
+    make_plot_for_each_category(show_plot, save_plot, category_dfs, categories, region_column, regions_count, type_of_analysis, renderer=renderer)
+
+def plot_diversity(diversity_df: pd.DataFrame, save_plot = False, show_plot = False, renderer = None):
+    """
+    Create a box plot of each diversity statistic for each category, one point for each patient.
+
+    Args:
+    - diversity_df (pd.DataFrame): Statistics of patients (see TCR_diversity.load_diversity).
+    - save_plot (bool): Whether to save the plots.
+    - show_plot (bool): Whether to display the plots.
+    - renderer (PlotRenderer): Queue saved plots to the renderer instead of exporting them now.
+    """
+    for statistic in DIVERSITY_STATISTICS:
+        fig = px.box(diversity_df, x="category", y=statistic, color="category", points="all", hover_data=["patient_id"])
+        fig.update_layout(title=f"{statistic} of patients in each category", xaxis_title="Category", yaxis_title=statistic,
+                          showlegend=False, height=600, width=1200)
+
+        if show_plot: fig.show()
+        if save_plot: export_plot(fig, f"Analysis/diversity/{statistic}.png", renderer)
+
+def Make_analysis(data_df: pd.DataFrame, region_column, type_of_analysis, save_plot = False, show_plot = False, regions_count = 10):
+    """
+    Perform analysis on the provided TCR data, creating and saving plots for the specified region column and type of analysis.
+    For several regions_count values use rank_regions once and plot_top_regions for each value.
+
+    Args:
+    - data_df (pd.DataFrame): The input dataframe containing TCR data.
+    - region_column (str): The column name for regions in the dataset.
+    - type_of_analysis (str): The type of analysis to perform ('frequency' or 'sum').
+    - save_plot (bool): Whether to save the plots.
+    - show_plot (bool): Whether to display the plots.
+    - regions_count (int): Number of top regions to include in the analysis.
+    """     
+    ranked_dfs = rank_regions(data_df, region_column)[type_of_analysis]
+    plot_top_regions(ranked_dfs, region_column, type_of_analysis, save_plot=save_plot, show_plot=show_plot, regions_count=regions_count)
 
 def make_dirs():
     # make dir for each combination of analysis TYPE_OF_ANALYSIS, REGIONS_COUNT_LIST, REGIONS_LIST
     if not os.path.exists("Analysis"):
             os.makedirs("Analysis")
     
+    if not os.path.exists("Analysis/diversity"):
+        os.makedirs("Analysis/diversity")
+
     for analysis, count, regions_name in product(TYPE_OF_ANALYSIS, REGIONS_COUNT_LIST, REGIONS_LIST_NAMES):
         # Construct the directory name based on the current combination
         dir_name = f"Analysis/{analysis}_TOP_{count}_{regions_name}"
@@ -218,10 +346,18 @@ def make_dirs():
     
 
 TYPE_OF_ANALYSIS = ["frequency", "sum"]
+ANALYSIS_OUTPUT_COLUMNS = {"frequency": "ratio", "sum": "specific_seq_count"} # column summed for each type of analysis
 REGIONS_COUNT_LIST = [10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
 REGIONS_LIST_NAMES = ["VJ_region", "V_region", "J_region"]
 SAVE_PLOTS = True
+RENDER_WORKERS = min(4, os.cpu_count() or 1) # processes exporting plots to images (one Chromium each), 1 = export in the main process
+CACHE = Cache() # category aggregates, see make_category_dataframes
 SHOW_PLOTS = False
+PLOT_DIVERSITY = True # box plots of diversity statistics of patients, see TCR_DATASETS/TCR_diversity.py
+DIVERSITY_DATASET = "VJ_DEPENDENT" # clones are CDR3 sequences together with their V and J regions
+PROFILE = True # write a JSON report of duration, rows and peak memory of each stage to reports/ (see TCR_profile.py)
+
+ANALYSIS_COLUMNS = ["patient_id", "category", "specific_seq_count", "ratio"]
 
 TCR_DATASETS = {
     "J_region": "J_DEPENDENT",
@@ -231,10 +367,39 @@ TCR_DATASETS = {
 
 if __name__ == "__main__":
     make_dirs()
-    for analysis, count, regions_name in product(TYPE_OF_ANALYSIS, REGIONS_COUNT_LIST, REGIONS_LIST_NAMES):
-        data_df = load_tcr_data(TCR_DATASETS[regions_name])
-        if regions_name == "VJ_region": data_df["VJ_region"] = data_df["V_region"] + "_" + data_df["J_region"]
-        Make_analysis(data_df, regions_name, analysis, save_plot = SAVE_PLOTS,show_plot = SHOW_PLOTS, regions_count = count)
+    renderer = PlotRenderer(workers=RENDER_WORKERS)
+
+    # each dataset is loaded, aggregated and sorted once, every top N plot is made from the same ranked regions
+    for regions_name in REGIONS_LIST_NAMES:
+        with stage(regions_name):
+            with stage("load_tcr_data") as record:
+                # clonotype_sequence is not needed for the analysis, only these columns are loaded
+                region_columns = ["V_region", "J_region"] if regions_name == "VJ_region" else [regions_name]
+                data_df = load_tcr_data(TCR_DATASETS[regions_name], columns=ANALYSIS_COLUMNS + region_columns)
+                if regions_name == "VJ_region": data_df["VJ_region"] = make_vj_region(data_df)
+                record["rows_out"] = len(data_df)
+
+            with stage("rank_regions", len(data_df)):
+                ranked_dfs = rank_regions(data_df, regions_name)
+
+            plots = list(product(TYPE_OF_ANALYSIS, REGIONS_COUNT_LIST))
+            with stage("plot_top_regions", len(plots)):
+                for analysis, count in progress(plots, desc=f"Plotting {regions_name}", unit="plot"):
+                    plot_top_regions(ranked_dfs[analysis], regions_name, analysis, save_plot = SAVE_PLOTS, show_plot = SHOW_PLOTS, regions_count = count, renderer = renderer)
+
+            renderer.render() # export plots of the dataset before the next one is loaded
+
+    if PLOT_DIVERSITY:
+        with stage("diversity"):
+            with stage("load_diversity") as record:
+                diversity_df = load_diversity(DIVERSITY_DATASET)
+                record["rows_out"] = len(diversity_df)
+            plot_diversity(diversity_df, save_plot = SAVE_PLOTS, show_plot = SHOW_PLOTS, renderer = renderer)
+            renderer.render()
+
+    if PROFILE:
+        print(PROFILER.summary())
+        print("Profile saved to " + PROFILER.save())
 
 
 
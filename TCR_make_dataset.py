@@ -2,17 +2,289 @@ import pandas as pd
 import numpy as np
 import pyreadr as pr
 import os
+import json
 from copy import deepcopy
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Iterator
+
+from TCR_DATASETS.TCR_load import load_tcr_data, make_vj_region, save_tcr_data, pq
+from TCR_DATASETS.TCR_sequences import SequenceStore
+from TCR_DATASETS.TCR_diversity import dataset_version, update_diversity
+from TCR_cache import Cache, fingerprint_file, make_key
+from TCR_profile import PROFILER, progress, stage
+from TCR_DATASETS.integrity import check_datasets, print_report
+
+BACKUP = True # cache the cleaned productive table in backup/cache, it is cleaned again only after Databaze files change
+STREAMING = False # process the productive table in chunks - peak memory depends on CHUNK_SIZE and number of unique sequences, not on the table size
+CHUNK_SIZE = 1_000_000 # number of rows read at once in streaming mode
+EXPORT_PARQUET = True # export datasets in columnar Parquet format too (requires pyarrow), load_tcr_data prefers it over CSV
+VECTORIZED = True # use clean_data_vectorized instead of the row by row clean_data, output is the same
+PARTITIONED = False # clean and count ranges of patients on a process pool, see make_datasets_partitioned
+WORKERS = os.cpu_count() # processes (and partitions) in partitioned mode
+INCREMENTAL = False # rebuild only patients whose rows in the productive table changed since the last build, see update_datasets
+PATIENTS_MANIFEST = "TCR_DATASETS/patients_manifest.json" # fingerprints of patients in the last build
+CHECK_INTEGRITY = True # check the exported datasets after the build, see TCR_DATASETS/integrity.py
+PROFILE = True # write a JSON report of duration, rows and peak memory of each stage to reports/ (see TCR_profile.py)
+SEQUENCE_STORE = True # add exported sequences to the global sequence store (requires pyarrow), see TCR_DATASETS/TCR_sequences.py
+
+REPLACEMENTS: list[str] = ["VJ:Vb-(Db)-Jb", "VJ:Va-Ja", "VJ:VJ:Vh-(Dh)-Jh", "VJ:Vl-Jl", "VJ:Vk-Jk", "VJ:Va-Jd", "VJ:Vh-(Dh)-Jh", "VJ:Vg-Jg"]
 
-BACKUP = True
+# dataset_info = [group_by, drop, name]
+VJ_INDEPENDENT_INFO = [["patient_id", "clonotype_sequence"], ["V_region", "J_region"], "VJ_independent"]
+VJ_DEPENDENT_INFO = [["patient_id", "clonotype_sequence", "V_region", "J_region"], None, "VJ_dependent"]
+V_DEPENDENT_INFO = [["patient_id", "clonotype_sequence", "V_region"], ["J_region"], "V_dependent"]
+J_DEPENDENT_INFO = [["patient_id", "clonotype_sequence", "J_region"], ["V_region"], "J_dependent"]
+
+DATASETS_INFO = [VJ_INDEPENDENT_INFO, VJ_DEPENDENT_INFO, V_DEPENDENT_INFO, J_DEPENDENT_INFO]
+
+CACHE = Cache()
+
+def source_path() -> str:
+    # productive table in Databaze folder, CSV is preferred over RData
+    if os.path.exists("Databaze/table_productive.csv"):
+        return "Databaze/table_productive.csv"
+    return "Databaze/table_productive.RData"
+
+def productive_key() -> str:
+    # cleaned table depends on the productive table and on categories from the vial codes
+    return make_key("productive", fingerprint_file(source_path()), fingerprint_file("Databaze/HEDIMED_kodovani.xlsx"))
 
 def load_data() -> pd.DataFrame:
-    if not os.path.exists("backup/productive_backup.csv"):
-        if not os.path.exists("Databaze/table_productive.csv"):
-            return pr.read_r("Databaze/table_productive.RData")["table_productive"] # load data from RData file
-        return pd.DataFrame(pd.read_csv("Databaze/table_productive.csv"))
-    
-    return pd.DataFrame(pd.read_csv("backup/productive_backup.csv"))
+    """
+    Load the cleaned productive table. With BACKUP the cleaned table is cached under the fingerprint of the Databaze files.
+
+    Returns:
+    - pd.DataFrame: Cleaned productive table (see clean_data).
+    """
+    key = productive_key()
+    if BACKUP and key in CACHE:
+        with stage("load_cached") as record:
+            data_df = CACHE.get(key)
+            record["rows_out"] = len(data_df)
+        return data_df
+
+    data_df = load_raw_data()
+    with stage("clean", len(data_df)) as record:
+        data_df = clean(data_df, load_vial_codes())
+        record["rows_out"] = len(data_df)
+    if BACKUP:
+        CACHE.put(key, data_df)
+        print("Backup created")
+    return data_df
+
+def load_raw_data() -> pd.DataFrame:
+    # raw productive table from the CSV or RData file
+    with stage("load_raw_data") as record:
+        if source_path().endswith(".csv"):
+            data_df = pd.DataFrame(pd.read_csv(source_path()))
+        else:
+            data_df = pr.read_r(source_path())["table_productive"] # load data from RData file
+        record["rows_out"] = len(data_df)
+    print("Database loaded. Shape: " + str(data_df.shape))
+    return data_df
+
+def load_data_chunks(chunksize: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Read the raw productive table in chunks of `chunksize` rows.
+    The CSV file is streamed from disk. pyreadr can not read RData files partially, so the RData table is loaded once and sliced.
+
+    Args:
+    - chunksize (int): Number of rows in each chunk.
+
+    Returns:
+    - Iterator[pd.DataFrame]: Chunks of the raw productive table.
+    """
+    if source_path().endswith(".csv"):
+        with pd.read_csv(source_path(), chunksize=chunksize) as reader:
+            yield from reader
+    else:
+        table: pd.DataFrame = pr.read_r(source_path())["table_productive"]
+        for start in range(0, len(table), chunksize):
+            yield table.iloc[start:start + chunksize].copy()
+
+def load_clean_chunks(chunksize: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Clean the productive table in chunks. With BACKUP the cleaned chunks are cached like in load_data,
+    the cache entry is complete only when all chunks were read.
+
+    Args:
+    - chunksize (int): Number of rows in each chunk.
+
+    Returns:
+    - Iterator[pd.DataFrame]: Cleaned chunks of the productive table.
+    """
+    key = productive_key()
+    if BACKUP and key in CACHE:
+        yield from CACHE.iter_batches(key)
+        return
+
+    vial_code_data = load_vial_codes()
+    with (CACHE.writer(key) if BACKUP else nullcontext()) as write:
+        for chunk in load_data_chunks(chunksize):
+            with stage("clean", len(chunk)) as record:
+                chunk = clean(chunk, vial_code_data, verbose=False)
+                record["rows_out"] = len(chunk)
+            if write is not None: write(chunk)
+            yield chunk
+
+def load_vial_codes() -> pd.DataFrame:
+    # category for each patient, Vial code is renamed to patient_id for merging with the productive table
+    vial_code_data = pd.DataFrame(pd.read_excel('Databaze/HEDIMED_kodovani.xlsx', usecols= ['category', 'Vial code'], dtype = {'category': "string", 'Vial code': "string"}))
+    vial_code_data.rename(columns={"Vial code": "patient_id"}, inplace=True)
+    return vial_code_data
+
+def clean_data(data_df: pd.DataFrame, vial_code_data: pd.DataFrame, verbose: bool = True) -> pd.DataFrame:
+    """
+    Clean the raw productive table: strip clonotypes to V and J regions, shorten samples to patient_id and add categories.
+
+    Args:
+    - data_df (pd.DataFrame): Raw productive table (or a chunk of it) with sample, clonotype and clonotype_sequence columns.
+    - vial_code_data (pd.DataFrame): Categories for each patient_id (see load_vial_codes).
+    - verbose (bool): Whether to print progress of each step.
+
+    Returns:
+    - pd.DataFrame: Cleaned dataframe with patient_id, clonotype_sequence, V_region, J_region and category columns.
+    """
+    log = print if verbose else (lambda *args: None)
+
+    for replacement in REPLACEMENTS: 
+        data_df["clonotype"] = data_df["clonotype"].str.replace(replacement, "") # remove types of regions from clonotype
+    # before: VJ:Vb-(Db)-Jb  V10-1 -0/14/-5 J2-7  CASSESAGVTHEQYF
+    # after: V10-1 -0/14/-5 J2-7  CASSESAGVTHEQYF
+    log("Types of regions removed")
+
+    data_df["clonotype"] = data_df.apply(lambda x: x["clonotype"].replace(x["clonotype_sequence"], ""), axis=1) # remove clonotype_sequence from clonotype
+    # before: V10-1 -0/14/-5 J2-7  CASSESAGVTHEQYF
+    # after: V10-1 -0/14/-5 J2-7
+    log("Clonotype sequences removed")
+
+    data_df["clonotype"] = data_df["clonotype"].str.replace("~", "") # remove ~ from clonotype
+    log("~ removed")
+    data_df["clonotype"] = data_df["clonotype"].str.lstrip() # remove leading whitespaces
+    log("Leading whitespaces removed")
+    data_df["clonotype"] = data_df["clonotype"].str.rstrip() # remove trailing whitespaces
+    log("Trailing whitespaces removed")
+    log("Clonotypes cleaned")
+    log("-"*50)
+
+    """
+    Fix invalid clonotypes. There are rows: 496130, 533406, 14096288, 14468978, 15161098, 15452605, 16920138, 18676245, 26100297 that have invalid clonoty_sequence:
+                        sample                                      clonotype                   clonotype_sequence
+    496130         1A7_TRB-VJ_S7_R1_001            VJ:Vb-(Db)-Jb  V5-6 -18/3/-22 J2-3  V                  V
+    533406         1A8_TRB-VJ_S8_R1_001             VJ:Vb-(Db)-Jb  V27 -34/0/-16 J2-7  V                  V
+    14096288   3G3-TRB-VJ_S89_merged_R1  VJ:Vb-(Db)-Jb  V5-5=V5-6=V5-7 -40/3/-26 J1-5  V                  V
+    14468978   3G8-TRB-VJ_S94_merged_R1     VJ:Vb-(Db)-Jb  V11-1=V11-3 -18/0/-16 J2-7  V                  V
+    15161098  3H7-TRB-VJ_S102_merged_R1             VJ:Vb-(Db)-Jb  V28 -18/0/-16 J2-7  V                  V
+    15452605  3I1-TRB-VJ_S105_merged_R1  VJ:Vb-(Db)-Jb  V5-5=V5-6=V5-7 -40/3/-26 J1-5  V                  V
+    16920138  4B3-TRB-VJ_S124_merged_R1             VJ:Vb-(Db)-Jb  V18 -41/1/-20 J1-5  V                  V
+    18676245   4D6-TRB-VJ_S21_merged_R1            VJ:Vb-(Db)-Jb  V7-2 -23/1/-21 J1-4  V                  V
+    26100297  5E8-TRB-VJ_S111_merged_R1  VJ:Vb-(Db)-Jb  V5-5=V5-6=V5-7 -40/3/-26 J1-5  V                  V
+
+    V will be added to the beginning of the clonotype, because it was removed by cleaning clonotypes:
+    data_df["clonotype"] = data_df.apply(lambda x: x["clonotype"].replace(x["clonotype_sequence"], ""), axis=1)
+    before: V5-6 -18/3/-22 J2-3 V     V
+    after: 5-6 -18/3/-22 J2-3
+
+    Sample will be removed no metter what, because clonoype_sequence does not start with C and end with F, but will be count for ratio calculation
+    """
+
+    # iterate over index labels, chunks of the table do not start at 0
+    for index, row in data_df["clonotype"].items():
+        if not row.startswith("V") or not row[1].isdigit():
+            data_df.at[index, "clonotype"] = "V" + data_df.at[index, "clonotype"]
+
+    log("Invalid clonotypes fixed")
+
+    data_df["sample"] = data_df["sample"].str.replace("HEDIMED-", "") # remove HEDIMED- from sample
+    data_df["sample"] = data_df["sample"].str[:3] # take first 3 characters from sample
+    data_df["sample"] = data_df["sample"].astype(str) 
+    data_df.rename(columns={"sample": "patient_id"}, inplace=True) # rename sample to patient_id
+    # before: HEDIMED-1A7_TRB-VJ_S7_R1_001
+    # after: 1A7
+    log("Samples fixed")
+
+    # extract V and J regions from clonotype and add them to the dataframe as separate columns
+    data_df["V_region"] = data_df["clonotype"].astype(str).str.split().str[0]
+    data_df["J_region"] = data_df["clonotype"].astype(str).str.split().str[2]
+    data_df= data_df.drop(columns=["clonotype"])
+    log("Regions extracted")
+
+    # add category to the dataframe
+    data_df = pd.merge(data_df, vial_code_data, on="patient_id", how="left") # merge data_df with vial_code_data on patient_id
+    data_df["category"] = data_df["category"].fillna("Unknown") # fill NaN values in category with Unknown (Never occured in the dataset)
+    log("Vial codes added")
+
+    return data_df
+
+def make_patient_ids(sample: pd.Series) -> pd.Series:
+    # HEDIMED-1A7_TRB-VJ_S7_R1_001 -> 1A7
+    return sample.str.replace("HEDIMED-", "", regex=False).str[:3].astype(str)
+
+def clean_data_vectorized(data_df: pd.DataFrame, vial_code_data: pd.DataFrame, verbose: bool = True) -> pd.DataFrame:
+    """
+    Same cleaning as clean_data, but without the row-wise apply and the loop over invalid clonotypes.
+
+    Args:
+    - data_df (pd.DataFrame): Raw productive table (or a chunk of it) with sample, clonotype and clonotype_sequence columns.
+    - vial_code_data (pd.DataFrame): Categories for each patient_id (see load_vial_codes).
+    - verbose (bool): Whether to print progress of each step.
+
+    Returns:
+    - pd.DataFrame: Cleaned dataframe with patient_id, clonotype_sequence, V_region, J_region and category columns.
+    """
+    log = print if verbose else (lambda *args: None)
+
+    rows = len(data_df)
+    with stage("remove_region_types", rows):
+        clonotype: pd.Series = data_df["clonotype"]
+        for replacement in REPLACEMENTS:
+            clonotype = clonotype.str.replace(replacement, "", regex=False) # remove types of regions from clonotype
+    log("Types of regions removed")
+
+    with stage("remove_sequences", rows):
+        # every row removes a different sequence - pandas has no vectorized replace for that, plain str.replace in a comprehension
+        # is still much faster than apply(axis=1), which builds a Series for each row
+        clonotype = pd.Series([clonotype_row.replace(sequence, "") for clonotype_row, sequence in zip(clonotype.tolist(), data_df["clonotype_sequence"].tolist())],
+                              index=data_df.index)
+    log("Clonotype sequences removed")
+
+    with stage("strip_clonotypes", rows):
+        clonotype = clonotype.str.replace("~", "", regex=False).str.strip() # remove ~ and leading/trailing whitespaces
+    log("Clonotypes cleaned")
+
+    with stage("fix_invalid_clonotypes", rows):
+        # V was removed together with the invalid clonotype_sequence "V" - add it back (see clean_data)
+        invalid: pd.Series = ~clonotype.str.match(r"V\d", na=False)
+        clonotype = clonotype.mask(invalid, "V" + clonotype)
+    log("Invalid clonotypes fixed")
+
+    with stage("make_patient_ids", rows):
+        patient_id = make_patient_ids(data_df["sample"])
+    log("Samples fixed")
+
+    with stage("extract_regions", rows):
+        # V10-1 -0/14/-5 J2-7 -> V10-1, J2-7 with one split
+        regions: pd.DataFrame = clonotype.str.split(n=3, expand=True)
+        data_df = data_df.drop(columns=["clonotype"])
+        data_df["sample"] = patient_id
+        data_df.rename(columns={"sample": "patient_id"}, inplace=True)
+        data_df["V_region"] = regions[0]
+        data_df["J_region"] = regions[2] if 2 in regions.columns else np.nan
+    log("Regions extracted")
+
+    with stage("add_vial_codes", rows) as record:
+        data_df = pd.merge(data_df, vial_code_data, on="patient_id", how="left") # merge data_df with vial_code_data on patient_id
+        data_df["category"] = data_df["category"].fillna("Unknown") # fill NaN values in category with Unknown (Never occured in the dataset)
+        record["rows_out"] = len(data_df)
+    log("Vial codes added")
+
+    return data_df
+
+def clean(data_df: pd.DataFrame, vial_code_data: pd.DataFrame, verbose: bool = True) -> pd.DataFrame:
+    # clean_data_vectorized or clean_data, depending on VECTORIZED
+    return clean_data_vectorized(data_df, vial_code_data, verbose) if VECTORIZED else clean_data(data_df, vial_code_data, verbose)
 
 def make_dataset(df, group_by = ["patient_id", "clonotype_sequence"],drop = None) -> pd.DataFrame:
     working_df = deepcopy(df) # copy the dataframe to avoid changing the original one
@@ -38,108 +310,446 @@ def make_dataset(df, group_by = ["patient_id", "clonotype_sequence"],drop = None
 
     return working_df
 
+def count_sequences(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.Series]:
+    """
+    Reduce a cleaned dataframe to the counts make_dataset needs. Rows of the result are the distinct rows of the
+    C...F sequences in order of their first occurrence, all sequences are counted for the patient totals.
+
+    Args:
+    - df (pd.DataFrame): Cleaned dataframe (see clean_data).
+
+    Returns:
+    - tuple[pd.DataFrame, pd.Series]: Distinct rows with their "count" column and number of all sequences for each patient.
+    """
+    patient_totals: pd.Series = df.groupby("patient_id", sort=False).size() # count all sequences for each patient
+
+    # only sequences that start with C and end with F are exported, same as in make_dataset
+    working_df = df[df["clonotype_sequence"].str.startswith("C", na=False) & df["clonotype_sequence"].str.endswith("F", na=False)]
+    counts = working_df.groupby(list(working_df.columns), sort=False, dropna=False).size().rename("count").reset_index()
+
+    return counts, patient_totals
+
+def merge_counts(counts: list[pd.DataFrame], patient_totals: list[pd.Series]) -> tuple[pd.DataFrame, pd.Series]:
+    """
+    Merge partial results of count_sequences (e.g. from chunks of the table). Order of the first occurrence is kept.
+
+    Args:
+    - counts (list[pd.DataFrame]): Distinct rows with counts in the order of the chunks.
+    - patient_totals (list[pd.Series]): Number of all sequences for each patient in the order of the chunks.
+
+    Returns:
+    - tuple[pd.DataFrame, pd.Series]: Merged counts and patient totals.
+    """
+    counts_df = pd.concat(counts, ignore_index=True)
+    keys = [column for column in counts_df.columns if column != "count"]
+    counts_df = counts_df.groupby(keys, sort=False, dropna=False)["count"].sum().reset_index()
+
+    totals = pd.concat(patient_totals)
+    totals = totals.groupby(level=0, sort=False).sum()
+
+    return counts_df, totals
+
+def make_dataset_from_counts(counts: pd.DataFrame, patient_totals: pd.Series, group_by = ["patient_id", "clonotype_sequence"], drop = None) -> pd.DataFrame:
+    """
+    Same output as make_dataset, but computed from the result of count_sequences/merge_counts instead of all rows.
+
+    Args:
+    - counts (pd.DataFrame): Distinct rows with their "count" column.
+    - patient_totals (pd.Series): Number of all sequences for each patient.
+    - group_by (list): Columns that define a specific sequence.
+    - drop (list): Columns that are not needed for ratio calculation.
+
+    Returns:
+    - pd.DataFrame: Dataset with specific_seq_count and ratio for each group.
+    """
+    if drop is not None:
+        # rows that differ only in dropped columns are duplicates now
+        working_df = counts.drop(columns=drop)
+        keys = [column for column in working_df.columns if column != "count"]
+        working_df = working_df.groupby(keys, sort=False, dropna=False)["count"].sum().reset_index()
+    else:
+        working_df = counts.copy() # rows of counts are already distinct
+    working_df["specific_seq_count"] = working_df.groupby(group_by, sort=False, dropna=False)["count"].transform("sum") # count specific sequences for each group
+    working_df["ratio"] = working_df["specific_seq_count"] / working_df["patient_id"].map(patient_totals) # calculate ratio of specific sequences to all sequences
+    working_df.drop(columns=["count"], inplace=True)
+
+    working_df.sort_values(by=["patient_id", "specific_seq_count"], inplace=True)
+
+    return working_df
+
+def encode_columns(df: pd.DataFrame, columns: list) -> tuple[pd.DataFrame, dict]:
+    """
+    Replace values of the columns with integer codes. Codes of patient_id follow the sorted order of patient ids,
+    so sorting by the codes gives the same order as sorting by the ids.
+
+    Args:
+    - df (pd.DataFrame): Input dataframe.
+    - columns (list): Columns to encode.
+
+    Returns:
+    - tuple[pd.DataFrame, dict]: Dataframe with encoded columns and column -> unique values (index of the value is its code).
+    """
+    encoded = pd.DataFrame(index=df.index)
+    uniques: dict = {}
+    for column in df.columns:
+        if column in columns:
+            encoded[column], uniques[column] = pd.factorize(df[column], sort=column == "patient_id", use_na_sentinel=False)
+        else:
+            encoded[column] = df[column]
+    return encoded, uniques
+
+def decode_columns(df: pd.DataFrame, uniques: dict) -> pd.DataFrame:
+    # replace integer codes with the original values (see encode_columns)
+    for column, values in uniques.items():
+        if column in df.columns:
+            df[column] = pd.Index(values).take(df[column].to_numpy())
+    return df
+
+def derive_datasets(counts: pd.DataFrame, patient_totals: pd.Series, datasets_info: list = DATASETS_INFO, uniques: dict = None) -> dict:
+    """
+    Make all datasets from one shared table of counts (see count_sequences).
+
+    Args:
+    - counts (pd.DataFrame): Distinct rows with their "count" column, possibly encoded.
+    - patient_totals (pd.Series): Number of all sequences for each patient.
+    - datasets_info (list): List of [group_by, drop, name] for each dataset.
+    - uniques (dict): Values of the encoded columns (see encode_columns), None if counts are not encoded.
+
+    Returns:
+    - dict: Dataset name -> dataset.
+    """
+    datasets: dict = {}
+    for group_by, drop, name in datasets_info:
+        with stage(f"make_dataset/{name}", len(counts)) as record:
+            dataset = make_dataset_from_counts(counts, patient_totals, group_by=group_by, drop=drop)
+            datasets[name] = decode_columns(dataset, uniques) if uniques is not None else dataset
+            record["rows_out"] = len(dataset)
+    return datasets
+
+def make_datasets(df: pd.DataFrame, datasets_info: list = DATASETS_INFO) -> dict:
+    """
+    Same output as make_dataset called for each dataset in datasets_info. Per-patient totals, the C...F filter
+    and counting of distinct rows are done once on integer codes and all datasets are derived from the shared counts.
+
+    Args:
+    - df (pd.DataFrame): Cleaned dataframe (see clean_data).
+    - datasets_info (list): List of [group_by, drop, name] for each dataset.
+
+    Returns:
+    - dict: Dataset name -> dataset.
+    """
+    with stage("count_sequences", len(df)) as record:
+        encoded, uniques = encode_columns(df, list(df.columns))
+        patient_totals: pd.Series = encoded.groupby("patient_id", sort=False).size() # count all sequences for each patient
+
+        # filter out sequences that do not start with C and end with F - checked once for each unique sequence
+        sequences = pd.Series(uniques["clonotype_sequence"])
+        valid_sequences = (sequences.str.startswith("C", na=False) & sequences.str.endswith("F", na=False)).to_numpy()
+        encoded = encoded[valid_sequences[encoded["clonotype_sequence"].to_numpy()]]
+
+        counts = encoded.groupby(list(encoded.columns), sort=False).size().rename("count").reset_index()
+        record["rows_out"] = len(counts)
+        del encoded
+
+    return derive_datasets(counts, patient_totals, datasets_info, uniques)
+
+def make_datasets_streaming(datasets_info: list = DATASETS_INFO, chunksize: int = CHUNK_SIZE) -> dict:
+    """
+    Clean the productive table chunk by chunk and make all datasets from the accumulated counts.
+    Only distinct rows with counts are kept in memory, the raw table is never loaded at once.
+
+    Args:
+    - datasets_info (list): List of [group_by, drop, name] for each dataset.
+    - chunksize (int): Number of rows read at once.
+
+    Returns:
+    - dict: Dataset name -> dataset.
+    """
+    counts, patient_totals = [], []
+    pending_rows, merged_rows = 0, 0
+    rows = 0
+    progress_bar = progress(desc="Processing chunks", unit="row")
+    for chunk in load_clean_chunks(chunksize):
+        rows += len(chunk)
+        with stage("count_sequences", len(chunk)) as record:
+            chunk_counts, chunk_totals = count_sequences(chunk)
+            record["rows_out"] = len(chunk_counts)
+        counts.append(chunk_counts)
+        patient_totals.append(chunk_totals)
+        pending_rows += len(chunk_counts)
+
+        # merge partial counts once they outgrow the merged ones - memory stays bounded and every row is merged only a few times
+        if pending_rows >= max(merged_rows, chunksize):
+            with stage("merge_counts", merged_rows + pending_rows) as record:
+                merged_counts, merged_totals = merge_counts(counts, patient_totals)
+                record["rows_out"] = len(merged_counts)
+            counts, patient_totals = [merged_counts], [merged_totals]
+            merged_rows, pending_rows = len(merged_counts), 0
+        progress_bar.update(len(chunk))
+    progress_bar.close()
+
+    with stage("merge_counts", merged_rows + pending_rows) as record:
+        counts_df, totals = merge_counts(counts, patient_totals)
+        record["rows_out"] = len(counts_df)
+    print("Database processed. Rows: " + str(rows) + ", distinct sequences: " + str(len(counts_df)))
+
+    # shared intermediate for all datasets, grouping on integer codes is much cheaper than on strings
+    encoded, uniques = encode_columns(counts_df, [column for column in counts_df.columns if column != "count"])
+    totals.index = pd.Index(uniques["patient_id"]).get_indexer(totals.index) # patients without any C...F sequence get -1 and are never looked up
+
+    return derive_datasets(encoded, totals, datasets_info, uniques)
+
+def partition_patients(patient_ids: pd.Series, partitions: int) -> np.ndarray:
+    """
+    Range partition rows by patient_id. Sorted patients are split into `partitions` contiguous ranges with about
+    the same number of rows, so concatenated results of the partitions are still sorted by patient_id.
+
+    Args:
+    - patient_ids (pd.Series): patient_id of each row.
+    - partitions (int): Number of partitions.
+
+    Returns:
+    - np.ndarray: Partition number of each row, partitions without any patient are skipped.
+    """
+    codes, patients = pd.factorize(patient_ids, sort=True)
+    patient_rows = np.bincount(codes, minlength=len(patients))
+    # partition of a patient is given by the rows of the patients before it, a patient is never split
+    patient_partitions = (np.cumsum(patient_rows) - patient_rows) * partitions // max(len(codes), 1)
+    return patient_partitions[codes]
+
+def process_partition(data_df: pd.DataFrame, vial_code_data: pd.DataFrame, datasets_info: list = DATASETS_INFO) -> dict:
+    # clean the raw rows of a partition (already cleaned if vial_code_data is None) and make all datasets of it
+    if vial_code_data is not None:
+        data_df = clean(data_df, vial_code_data, verbose=False)
+    return make_datasets(data_df, datasets_info)
+
+def make_datasets_partitioned(datasets_info: list = DATASETS_INFO, workers: int = WORKERS) -> dict:
+    """
+    Same output as make_datasets, but cleaning and counting run on a process pool. Every dataset row depends only on rows
+    of its patient, so the table is range partitioned by patient_id (see partition_patients) and results of the partitions
+    are concatenated in order. The cached cleaned table is used if it exists, otherwise the raw table is cleaned in the workers.
+
+    Args:
+    - datasets_info (list): List of [group_by, drop, name] for each dataset.
+    - workers (int): Number of processes and partitions.
+
+    Returns:
+    - dict: Dataset name -> dataset.
+    """
+    key = productive_key()
+    if BACKUP and key in CACHE:
+        data_df, vial_code_data = CACHE.get(key), None
+        patient_ids = data_df["patient_id"]
+    else:
+        data_df, vial_code_data = load_raw_data(), load_vial_codes()
+        patient_ids = make_patient_ids(data_df["sample"])
+
+    partitions = partition_patients(patient_ids, workers)
+    order = np.argsort(partitions, kind="stable") # rows of each partition keep their order
+    bounds = np.searchsorted(partitions[order], np.arange(workers + 1))
+    parts = [data_df.iloc[order[start:stop]] for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+    del data_df, patient_ids
+    print(f"Table partitioned by patient_id. Partitions: {len(parts)}")
+
+    # stages run in the workers are not recorded, only the whole pool
+    with stage("process_partitions", sum(len(part) for part in parts)) as record, ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(progress(executor.map(process_partition, parts, repeat(vial_code_data), repeat(datasets_info)),
+                                desc="Processing partitions", total=len(parts), unit="partition"))
+        record["rows_out"] = sum(len(result[name]) for result in results for _, _, name in datasets_info)
+
+    return {name: pd.concat([result[name] for result in results], ignore_index=True) for _, _, name in datasets_info}
+
 def export_dataframe(df, name) -> None:
     path = "TCR_DATASETS/"
     if not os.path.exists(path):
         os.makedirs(path)
-    name = "TCR_sequencing_hedimed_DATASET_" + name + ".csv"
-    df.to_csv(path + name, index=False)
-    print(name + " exported")
+    with stage(f"export/{name}", len(df)):
+        name = "TCR_sequencing_hedimed_DATASET_" + name + ".csv"
+        df.to_csv(path + name, index=False)
+        print(name + " exported")
+
+        if EXPORT_PARQUET and pq is not None:
+            save_tcr_data(df, path + name)
+            print(name.replace(".csv", ".parquet") + " exported")
+
+def update_sequence_store(datasets: dict) -> None:
+    # add sequences of exported datasets to the global sequence store, codes of already stored sequences do not change
+    # datasets differ only in grouping and have the same sequences, so only VJ_independent is encoded if it was built
+    if not SEQUENCE_STORE or pq is None or not datasets:
+        return
+    with stage("update_sequence_store") as record:
+        store = SequenceStore.load()
+        stored = len(store)
+        if "VJ_independent" in datasets:
+            store.encode(datasets["VJ_independent"]["clonotype_sequence"])
+        else:
+            store.encode(pd.unique(pd.concat([dataset["clonotype_sequence"].astype(object) for dataset in datasets.values()], ignore_index=True)))
+        store.save()
+        record["rows_out"] = len(store) - stored
+    print(f"Sequence store updated. Sequences: {len(store)}, new: {len(store) - stored}")
+
+def fingerprint_patients(chunksize: int = CHUNK_SIZE) -> dict:
+    """
+    Fingerprint rows of each patient in the raw productive table, chunk by chunk and without cleaning.
+    Row hashes are weighted by the position of the row within the patient, so reordered rows change the fingerprint too.
+    Category of the patient is part of the fingerprint, a patient moved to another category in the vial codes is rebuilt.
+
+    Args:
+    - chunksize (int): Number of rows read at once.
+
+    Returns:
+    - dict: patient_id -> fingerprint.
+    """
+    categories: dict = load_vial_codes().drop_duplicates("patient_id").set_index("patient_id")["category"].to_dict()
+    sums: dict = {}
+    rows: dict = {}
+    for chunk in load_data_chunks(chunksize):
+        codes, patients = pd.factorize(make_patient_ids(chunk["sample"]))
+        row_hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+
+        # position of each row within its patient, counted over all chunks read so far
+        offsets = np.array([rows.get(patient, 0) for patient in patients], dtype=np.uint64)
+        positions = pd.Series(codes).groupby(codes).cumcount().to_numpy().astype(np.uint64) + offsets[codes] + np.uint64(1)
+
+        chunk_sums = np.zeros(len(patients), dtype=np.uint64)
+        np.add.at(chunk_sums, codes, row_hashes * positions) # uint64 arithmetic wraps around, the sums are modulo 2**64
+        chunk_rows = np.bincount(codes, minlength=len(patients))
+        for patient, patient_sum, patient_rows in zip(patients, chunk_sums.tolist(), chunk_rows.tolist()):
+            sums[patient] = (sums.get(patient, 0) + patient_sum) % 2**64
+            rows[patient] = rows.get(patient, 0) + patient_rows
+
+    return {patient: f"{sums[patient]:016x}-{rows[patient]}-{categories.get(patient, 'Unknown')}" for patient in sums}
+
+def load_manifest() -> dict:
+    # fingerprints of patients in the exported datasets, None if the datasets were not built incrementally yet
+    if not os.path.exists(PATIENTS_MANIFEST):
+        return None
+    with open(PATIENTS_MANIFEST) as file:
+        return json.load(file)
+
+def save_manifest(fingerprints: dict) -> None:
+    # written after all datasets are exported, interrupted update is repeated next time
+    with open(PATIENTS_MANIFEST + ".tmp", "w") as file:
+        json.dump(fingerprints, file, indent=0, sort_keys=True)
+    os.replace(PATIENTS_MANIFEST + ".tmp", PATIENTS_MANIFEST)
+
+def dataset_path(name: str) -> str:
+    # CSV file of the dataset exported by export_dataframe
+    return "TCR_DATASETS/TCR_sequencing_hedimed_DATASET_" + name + ".csv"
+
+def replace_patients(old_df: pd.DataFrame, new_rows: pd.DataFrame, patients: set) -> pd.DataFrame:
+    """
+    Replace rows of the patients in an exported dataset. Datasets are sorted by patient_id and specific_seq_count
+    and the sort is stable, so the result is the same as the dataset made from the whole table.
+
+    Args:
+    - old_df (pd.DataFrame): Exported dataset.
+    - new_rows (pd.DataFrame): Rows of the rebuilt patients (from make_datasets).
+    - patients (set): Patients whose rows in old_df are removed (rebuilt and removed patients).
+
+    Returns:
+    - pd.DataFrame: Updated dataset.
+    """
+    kept = old_df[~old_df["patient_id"].isin(patients).to_numpy()]
+    merged = pd.concat([kept, new_rows[list(old_df.columns)]], ignore_index=True)
+    merged.sort_values(by=["patient_id", "specific_seq_count"], inplace=True)
+    return merged.reset_index(drop=True)
+
+def update_graph_aggregates(name: str, old_df: pd.DataFrame, new_df: pd.DataFrame, patients: set) -> None:
+    # update cached category aggregates of TCR_graphs by the replaced rows only (see update_category_dataframes)
+    from TCR_graphs import TCR_DATASETS as GRAPH_DATASETS, update_category_dataframes # plotting modules are imported only when needed
+
+    for region_column, NAME in GRAPH_DATASETS.items():
+        if NAME != name.upper():
+            continue
+        frames = [old_df, new_df, old_df[old_df["patient_id"].isin(patients).to_numpy()], new_df[new_df["patient_id"].isin(patients).to_numpy()]]
+        if region_column == "VJ_region":
+            frames = [frame.assign(VJ_region=make_vj_region(frame)) for frame in frames]
+        update_category_dataframes(region_column, *frames)
+
+def update_datasets(datasets_info: list = DATASETS_INFO, chunksize: int = CHUNK_SIZE) -> None:
+    """
+    Rebuild the exported datasets only for patients that are new or whose rows changed since the last build.
+    Every row of a dataset depends only on rows of its patient, so the rows of other patients are kept from the exported files.
+    Without the manifest of the last build or the exported files all datasets are built from scratch.
+
+    Args:
+    - datasets_info (list): List of [group_by, drop, name] for each dataset.
+    - chunksize (int): Number of rows read at once.
+    """
+    with stage("fingerprint_patients") as record:
+        fingerprints = fingerprint_patients(chunksize)
+        record["rows_out"] = len(fingerprints)
+    manifest = load_manifest()
+
+    if manifest is None or not all(os.path.exists(dataset_path(name)) for _, _, name in datasets_info):
+        print("No previous build found, all patients are processed")
+        if PARTITIONED: datasets = make_datasets_partitioned(datasets_info, WORKERS)
+        elif STREAMING: datasets = make_datasets_streaming(datasets_info, chunksize)
+        else: datasets = make_datasets(load_data(), datasets_info)
+        for name, dataset in datasets.items():
+            export_dataframe(dataset, name)
+        update_sequence_store(datasets)
+        save_manifest(fingerprints)
+        return
+
+    changed = {patient for patient, fingerprint in fingerprints.items() if manifest.get(patient) != fingerprint}
+    removed = set(manifest) - set(fingerprints)
+    print(f"New or changed patients: {len(changed)}, removed patients: {len(removed)}")
+    if not changed and not removed:
+        print("Datasets are up to date")
+        return
+
+    # only rows of the changed patients are cleaned and counted
+    vial_code_data = load_vial_codes()
+    chunks = []
+    for chunk in load_data_chunks(chunksize):
+        chunk = chunk[make_patient_ids(chunk["sample"]).isin(changed).to_numpy()]
+        if len(chunk):
+            with stage("clean", len(chunk)) as record:
+                chunks.append(clean(chunk, vial_code_data, verbose=False))
+                record["rows_out"] = len(chunks[-1])
+    new_datasets = make_datasets(pd.concat(chunks, ignore_index=True), datasets_info) if chunks else {}
+
+    for _, _, name in datasets_info:
+        old_df = load_tcr_data(name.upper())
+        old_df = old_df.astype({column: object for column in old_df.columns if isinstance(old_df[column].dtype, pd.CategoricalDtype)}) # missing regions stay missing
+        new_rows = new_datasets.get(name, old_df.iloc[:0])
+        new_df = replace_patients(old_df, new_rows, changed | removed)
+        version = dataset_version(name.upper())
+        export_dataframe(new_df, name)
+        with stage(f"update_graph_aggregates/{name}", len(new_rows)):
+            update_graph_aggregates(name, old_df, new_df, changed | removed)
+        update_diversity(name.upper(), version, new_rows, changed | removed) # cached diversity statistics of other patients are kept
+
+    update_sequence_store(new_datasets)
+    save_manifest(fingerprints)
 
 #_______________________________________________________________________________________________________________________
-data_df: pd.DataFrame = pd.DataFrame(pd.read_csv("Databaze/table_productive.csv"))
-print("Database loaded. Shape: " + str(data_df.shape))
-in_indexes = [496130, 533406,14096288,14468978, 15161098, 15452605, 16920138,18676245, 26100297 ]
-print(data_df.loc[in_indexes])
-
-replacements: list[str] = ["VJ:Vb-(Db)-Jb", "VJ:Va-Ja", "VJ:VJ:Vh-(Dh)-Jh", "VJ:Vl-Jl", "VJ:Vk-Jk", "VJ:Va-Jd", "VJ:Vh-(Dh)-Jh", "VJ:Vg-Jg"]
-
-for replacement in replacements: 
-    data_df["clonotype"] = data_df["clonotype"].str.replace(replacement, "") # remove types of regions from clonotype
-# before: VJ:Vb-(Db)-Jb  V10-1 -0/14/-5 J2-7  CASSESAGVTHEQYF
-# after: V10-1 -0/14/-5 J2-7  CASSESAGVTHEQYF
-print("Types of regions removed")
-
-
-data_df["clonotype"] = data_df.apply(lambda x: x["clonotype"].replace(x["clonotype_sequence"], ""), axis=1) # remove clonotype_sequence from clonotype
-# before: V10-1 -0/14/-5 J2-7  CASSESAGVTHEQYF
-# after: V10-1 -0/14/-5 J2-7
-print("Clonotype sequences removed")
-
-data_df["clonotype"] = data_df["clonotype"].str.replace("~", "") # remove ~ from clonotype
-print("~ removed")
-data_df["clonotype"] = data_df["clonotype"].str.lstrip() # remove leading whitespaces
-print("Leading whitespaces removed")
-data_df["clonotype"] = data_df["clonotype"].str.rstrip() # remove trailing whitespaces
-print("Trailing whitespaces removed")
-print("Clonotypes cleaned")
-print("-"*50)
-
-"""
-Fix invalid clonotypes. There are rows: 496130, 533406, 14096288, 14468978, 15161098, 15452605, 16920138, 18676245, 26100297 that have invalid clonoty_sequence:
-                    sample                                      clonotype                   clonotype_sequence
-496130         1A7_TRB-VJ_S7_R1_001            VJ:Vb-(Db)-Jb  V5-6 -18/3/-22 J2-3  V                  V
-533406         1A8_TRB-VJ_S8_R1_001             VJ:Vb-(Db)-Jb  V27 -34/0/-16 J2-7  V                  V
-14096288   3G3-TRB-VJ_S89_merged_R1  VJ:Vb-(Db)-Jb  V5-5=V5-6=V5-7 -40/3/-26 J1-5  V                  V
-14468978   3G8-TRB-VJ_S94_merged_R1     VJ:Vb-(Db)-Jb  V11-1=V11-3 -18/0/-16 J2-7  V                  V
-15161098  3H7-TRB-VJ_S102_merged_R1             VJ:Vb-(Db)-Jb  V28 -18/0/-16 J2-7  V                  V
-15452605  3I1-TRB-VJ_S105_merged_R1  VJ:Vb-(Db)-Jb  V5-5=V5-6=V5-7 -40/3/-26 J1-5  V                  V
-16920138  4B3-TRB-VJ_S124_merged_R1             VJ:Vb-(Db)-Jb  V18 -41/1/-20 J1-5  V                  V
-18676245   4D6-TRB-VJ_S21_merged_R1            VJ:Vb-(Db)-Jb  V7-2 -23/1/-21 J1-4  V                  V
-26100297  5E8-TRB-VJ_S111_merged_R1  VJ:Vb-(Db)-Jb  V5-5=V5-6=V5-7 -40/3/-26 J1-5  V                  V
-
-V will be added to the beginning of the clonotype, because it was removed by cleaning clonotypes:
-data_df["clonotype"] = data_df.apply(lambda x: x["clonotype"].replace(x["clonotype_sequence"], ""), axis=1)
-before: V5-6 -18/3/-22 J2-3 V     V
-after: 5-6 -18/3/-22 J2-3
-
-Sample will be removed no metter what, because clonoype_sequence does not start with C and end with F, but will be count for ratio calculation
-"""
-
-invalid_indices = [] 
-for index, row in enumerate(data_df["clonotype"]):
-    if not row.startswith("V") or not row[1].isdigit():
-        data_df.at[index, "clonotype"] = "V" + data_df.at[index, "clonotype"]
-
-print("Invalid clonotypes fixed")
-
-
-data_df["sample"] = data_df["sample"].str.replace("HEDIMED-", "") # remove HEDIMED- from sample
-data_df["sample"] = data_df["sample"].str[:3] # take first 3 characters from sample
-data_df["sample"] = data_df["sample"].astype(str) 
-data_df.rename(columns={"sample": "patient_id"}, inplace=True) # rename sample to patient_id
-# before: HEDIMED-1A7_TRB-VJ_S7_R1_001
-# after: 1A7
-print("Samples fixed")
-
-# extract V and J regions from clonotype and add them to the dataframe as separate columns
-data_df["V_region"] = data_df["clonotype"].astype(str).str.split().str[0]
-data_df["J_region"] = data_df["clonotype"].astype(str).str.split().str[2]
-data_df= data_df.drop(columns=["clonotype"])
-print("Regions extracted")
-
-
-# add category to the dataframe
-vial_code_data = pd.DataFrame(pd.read_excel('Databaze/HEDIMED_kodovani.xlsx', usecols= ['category', 'Vial code'], dtype = {'category': "string", 'Vial code': "string"}))
-
-
-vial_code_data.rename(columns={"Vial code": "patient_id"}, inplace=True) # rename Vial code to patient_id for merging with data_df on patient_id
-working_df = pd.merge(data_df, vial_code_data, on="patient_id", how="left") # merge data_df with vial_code_data on patient_id
-data_df["category"] = data_df["category"].fillna("Unknown") # fill NaN values in category with Unknown (Never occured in the dataset)
-print("Vial codes added")
-
-if BACKUP:
-    data_df.to_csv("backup/productive_backup.csv", index=False) # backup created. Load_data() will load this backup if it exists
-
-print("Backup created")
-print("Datframe ready" + str(data_df.shape))
+if __name__ == "__main__":
+    if INCREMENTAL:
+        update_datasets(DATASETS_INFO, CHUNK_SIZE)
 
-# dataset_info = [group_by, drop, name]
-VJ_INDEPENDENT_INFO = [["patient_id", "clonotype_sequence"], ["V_region", "J_region"], "VJ_independent"]
-VJ_DEPENDENT_INFO = [["patient_id", "clonotype_sequence", "V_region", "J_region"], None, "VJ_dependent"]
-V_DEPENDENT_INFO = [["patient_id", "clonotype_sequence", "V_region"], ["J_region"], "V_dependent"]
-J_DEPENDENT_INFO = [["patient_id", "clonotype_sequence", "J_region"], ["V_region"], "J_dependent"]
+    else:
+        if PARTITIONED:
+            datasets = make_datasets_partitioned(DATASETS_INFO, WORKERS)
 
-DATASETS_INFO = [VJ_INDEPENDENT_INFO, VJ_DEPENDENT_INFO, V_DEPENDENT_INFO, J_DEPENDENT_INFO]
-for dataset in DATASETS_INFO:
-    export_dataframe(make_dataset(data_df, group_by=dataset[0], drop=dataset[1]), dataset[2])
\ No newline at end of file
+        elif STREAMING:
+            datasets = make_datasets_streaming(DATASETS_INFO, CHUNK_SIZE)
+
+        else:
+            data_df: pd.DataFrame = load_data()
+            print("Datframe ready" + str(data_df.shape))
+            datasets = make_datasets(data_df, DATASETS_INFO)
+
+        for name, dataset in datasets.items():
+            export_dataframe(dataset, name)
+        update_sequence_store(datasets)
+
+    if CHECK_INTEGRITY:
+        with stage("check_integrity"):
+            print_report(check_datasets(workers=WORKERS))
+
+    if PROFILE:
+        print(PROFILER.summary())
+        print("Profile saved to " + PROFILER.save())
@@ -0,0 +1,164 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from typing import Iterator
+
+import joblib
+
+from TCR_DATASETS.TCR_load import load_tcr_data
+from TCR_DATASETS.TCR_features import aggregate_patient_regions, build_feature_matrix
+
+PREDICTOR_PATH = "backup/models/predictor.joblib" # default predictor saved from TCR_classifiers.ipynb
+BATCH_SIZE = 100 # patients scored at once
+PREDICTION_COLUMNS = ["patient_id", "category", "VJ_region", "ratio", "specific_seq_count"] # columns of TCR data used for features
+
+
+class TCRPredictor:
+    """
+    Fitted pipeline of TCR_classifiers.ipynb together with everything needed to make its features from new data:
+    VJ regions used as features (all_regions), value of the features, normalization and np.digitize bin edges.
+    """
+
+    def __init__(self, pipeline, regions: list, value: str = "ratio", normalize: bool = True, bins: np.ndarray = None):
+        self.pipeline = pipeline
+        self.regions = list(regions)
+        self.value = value # 'ratio' (dataset_freq) or 'specific_seq_count' (dataset_sum)
+        self.normalize = normalize # divide values by their sum over the regions, as dataset_freq
+        self.bins = np.asarray(bins) if bins is not None else None # bin edges of the training data, features are not binned if None
+
+        # V and J parts of the regions, rows with other regions do not change the features and are not loaded
+        V_regions, J_regions = zip(*(region.rsplit("_", 1) for region in self.regions)) if self.regions else ((), ())
+        self.V_regions, self.J_regions = sorted(set(V_regions)), sorted(set(J_regions))
+
+    def save(self, path: str = PREDICTOR_PATH) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        joblib.dump(self.__dict__, path)
+
+    @classmethod
+    def load(cls, path: str = PREDICTOR_PATH) -> "TCRPredictor":
+        state = joblib.load(path)
+        return cls(state["pipeline"], state["regions"], state["value"], state["normalize"], state["bins"])
+
+    def features(self, patient_regions: pd.DataFrame) -> pd.DataFrame:
+        """
+        Features of patients, made the same way as in TCR_classifiers.ipynb.
+
+        Args:
+        - patient_regions (pd.DataFrame): Output of aggregate_patient_regions.
+
+        Returns:
+        - pd.DataFrame: patient_id, one column for each region and category. Patients without any of the regions are left out.
+        """
+        dataset = build_feature_matrix(patient_regions, self.regions, value=self.value)
+        values = dataset[self.regions].to_numpy(dtype=float)
+        if self.normalize:
+            values = values / values.sum(axis=1, keepdims=True)
+        if self.bins is not None:
+            values = np.digitize(values, self.bins)
+        dataset[self.regions] = values
+        return dataset
+
+    def predict(self, patient_regions: pd.DataFrame) -> pd.DataFrame:
+        """
+        Predict categories of patients.
+
+        Args:
+        - patient_regions (pd.DataFrame): Output of aggregate_patient_regions.
+
+        Returns:
+        - pd.DataFrame: patient_id, known category, prediction and probability of each class (if the classifier has predict_proba).
+        """
+        dataset = self.features(patient_regions)
+        predictions = dataset[["patient_id", "category"]].reset_index(drop=True)
+        if not len(dataset):
+            return predictions.assign(prediction=pd.Series(dtype=object))
+
+        X = dataset[self.regions]
+        predictions["prediction"] = self.pipeline.predict(X)
+        if hasattr(self.pipeline, "predict_proba"):
+            probabilities = pd.DataFrame(self.pipeline.predict_proba(X), columns=[f"probability_{label}" for label in self.pipeline.classes_])
+            predictions = pd.concat([predictions, probabilities], axis=1)
+        return predictions
+
+    def predict_batches(self, batches) -> pd.DataFrame:
+        # predict TCR data (patient_id, category, VJ_region or V_region and J_region, ratio, specific_seq_count) batch by batch
+        predictions = [self.predict(aggregate_patient_regions(batch, region_column="VJ_region")) for batch in batches]
+        return pd.concat(predictions, ignore_index=True) if predictions else self.predict(pd.DataFrame(columns=PREDICTION_COLUMNS))
+
+    def predict_dataset(self, NAME: str = "VJ_DEPENDENT", patients: list = None, batch_size: int = BATCH_SIZE) -> pd.DataFrame:
+        """
+        Predict patients of a TCR dataset (see load_tcr_data). Patients are loaded in batches and only rows with V and J regions
+        of the features are read.
+
+        Args:
+        - NAME (str): Name of the dataset with V_region and J_region columns.
+        - patients (list): Patients to predict, all patients if None.
+        - batch_size (int): Number of patients loaded and predicted at once.
+
+        Returns:
+        - pd.DataFrame: Predictions (see predict).
+        """
+        if patients is None:
+            patients = load_tcr_data(NAME, columns=["patient_id"], categorical=False)["patient_id"].unique()
+        patients = sorted(patients)
+
+        def batches() -> Iterator[pd.DataFrame]:
+            for start in range(0, len(patients), batch_size):
+                yield load_tcr_data(NAME, columns=["patient_id", "category", "V_region", "J_region", "ratio", "specific_seq_count"],
+                                    patients=patients[start:start + batch_size], V_regions=self.V_regions, J_regions=self.J_regions)
+
+        return self.predict_batches(batches())
+
+    def predict_productive(self, data_df: pd.DataFrame, batch_size: int = BATCH_SIZE) -> pd.DataFrame:
+        """
+        Predict patients from raw rows of the productive table (sample, clonotype, clonotype_sequence), e.g. new sequencing runs.
+        Rows are cleaned and counted the same way as by TCR_make_dataset.py (VJ_dependent dataset).
+
+        Args:
+        - data_df (pd.DataFrame): Raw productive rows.
+        - batch_size (int): Number of patients cleaned and predicted at once.
+
+        Returns:
+        - pd.DataFrame: Predictions (see predict), category is "Unknown" for patients missing in the vial codes.
+        """
+        from TCR_make_dataset import VJ_DEPENDENT_INFO, clean, load_vial_codes, make_datasets, make_patient_ids # reads Databaze files only when used
+
+        vial_code_data = load_vial_codes()
+        patient_ids = make_patient_ids(data_df["sample"])
+        patients = sorted(patient_ids.unique())
+
+        def batches() -> Iterator[pd.DataFrame]:
+            for start in range(0, len(patients), batch_size):
+                batch = data_df[patient_ids.isin(patients[start:start + batch_size]).to_numpy()]
+                yield make_datasets(clean(batch.copy(), vial_code_data, verbose=False), [VJ_DEPENDENT_INFO])[VJ_DEPENDENT_INFO[2]]
+
+        return self.predict_batches(batches())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Predict categories of patients with a predictor saved from TCR_classifiers.ipynb.")
+    parser.add_argument("--model", default=PREDICTOR_PATH, help="path of the saved TCRPredictor")
+    parser.add_argument("--dataset", default="VJ_DEPENDENT", help="TCR dataset with the patients (see load_tcr_data)")
+    parser.add_argument("--productive", help="CSV file with raw productive rows, used instead of --dataset")
+    parser.add_argument("--patients", nargs="*", help="patients to predict, all patients if not given")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="patients predicted at once")
+    parser.add_argument("--output", default="predictions.csv", help="CSV file with the predictions")
+    args = parser.parse_args()
+
+    predictor = TCRPredictor.load(args.model)
+    if args.productive:
+        data_df = pd.read_csv(args.productive)
+        if args.patients:
+            from TCR_make_dataset import make_patient_ids
+            data_df = data_df[make_patient_ids(data_df["sample"]).isin(args.patients).to_numpy()]
+        predictions = predictor.predict_productive(data_df, args.batch_size)
+    else:
+        predictions = predictor.predict_dataset(args.dataset, args.patients, args.batch_size)
+
+    predictions.to_csv(args.output, index=False)
+    print(f"Patients predicted: {len(predictions)}, saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
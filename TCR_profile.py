@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import platform
+import threading
+import weakref
+from contextlib import contextmanager
+from datetime import datetime
+
+import tqdm
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+REPORTS_DIR = "reports" # JSON run reports, see Profiler.save
+SAMPLE_INTERVAL = 0.01 # seconds between memory samples
+
+
+def current_rss() -> int:
+    # resident memory of this process in bytes, the peak of the process where /proc is not available
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+class Profiler:
+    """
+    Records duration, rows in/out and peak memory of pipeline stages and shows progress bars.
+    Stages can be nested, the name of a nested stage is prefixed by its parents (clean/remove_sequences).
+    A stage that runs several times (e.g. for each chunk) is recorded once with the sums of its calls.
+    Memory is sampled by a background thread while any stage runs, work in worker processes is not included.
+    """
+    def __init__(self, enabled: bool = True, progress: bool = True):
+        """
+        Args:
+        - enabled (bool): Whether to record stages.
+        - progress (bool): Whether to show progress bars (see progress) and log the first call of each stage when it finishes.
+        """
+        self.enabled = enabled
+        self.show_progress = progress
+        self.stages: dict = {} # name -> record, in order of the first call
+        self.started = time.time()
+        self._active: list = [] # names and peaks of running stages, innermost last
+        self._lock = threading.Lock()
+        self._sampler = None
+        if hasattr(os, "register_at_fork"): # not available on Windows
+            method = weakref.WeakMethod(self._after_fork) # the profiler can still be garbage collected
+            os.register_at_fork(after_in_child=lambda: method() is not None and method()())
+
+    def _after_fork(self) -> None:
+        # a forked worker (see make_datasets_partitioned) gets no sampler thread and may inherit the lock held by it
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._active = []
+
+    def _sample(self) -> None:
+        # update peaks of all running stages until no stage runs
+        while True:
+            rss = current_rss()
+            with self._lock:
+                if not self._active:
+                    self._sampler = None
+                    return
+                for active in self._active:
+                    active["peak"] = max(active["peak"], rss)
+            time.sleep(SAMPLE_INTERVAL)
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int = None):
+        """
+        Record a stage. Set "rows_out" of the yielded dict to record the number of output rows.
+
+        Args:
+        - name (str): Name of the stage.
+        - rows_in (int): Number of input rows.
+        """
+        call = {"rows_out": None}
+        if not self.enabled:
+            yield call
+            return
+
+        with self._lock:
+            full_name = "/".join([active["name"] for active in self._active] + [name])
+            active = {"name": name, "peak": current_rss()}
+            self._active.append(active)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+
+        start = time.perf_counter()
+        try:
+            yield call
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._active.remove(active)
+                record = self.stages.setdefault(full_name, {"stage": full_name, "calls": 0, "seconds": 0.0, "rows_in": None, "rows_out": None, "peak_rss_mb": 0.0})
+                record["calls"] += 1
+                record["seconds"] += seconds
+                record["peak_rss_mb"] = max(record["peak_rss_mb"], max(active["peak"], current_rss()) / 2**20)
+                for key, rows in (("rows_in", rows_in), ("rows_out", call["rows_out"])):
+                    if rows is not None:
+                        record[key] = (record[key] or 0) + int(rows)
+                record["rows_per_second"] = record["rows_in"] / record["seconds"] if record["rows_in"] is not None and record["seconds"] > 0 else None
+            if self.show_progress and record["calls"] == 1: # repeated stages (chunks) are followed by their progress bars
+                tqdm.tqdm.write(f"[{full_name}] {seconds:.2f} s, peak {record['peak_rss_mb']:.0f} MB", file=sys.stderr)
+
+    def progress(self, iterable = None, desc: str = None, total: int = None, unit: str = "it"):
+        # tqdm progress bar, hidden if progress is disabled
+        return tqdm.tqdm(iterable, desc=desc, total=total, unit=unit, disable=not self.show_progress, file=sys.stderr)
+
+    def report(self) -> dict:
+        # machine-readable report of the run
+        return {
+            "script": os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else None,
+            "started": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "seconds": time.time() - self.started,
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "stages": list(self.stages.values()),
+        }
+
+    def summary(self) -> str:
+        # stages as a text table
+        lines = [f"{'stage':<50} {'calls':>6} {'seconds':>10} {'rows in':>12} {'rows out':>12} {'peak MB':>9}"]
+        for record in self.stages.values():
+            rows_in = "" if record["rows_in"] is None else f"{record['rows_in']:,}"
+            rows_out = "" if record["rows_out"] is None else f"{record['rows_out']:,}"
+            lines.append(f"{record['stage']:<50} {record['calls']:>6} {record['seconds']:>10.2f} {rows_in:>12} {rows_out:>12} {record['peak_rss_mb']:>9.0f}")
+        return "\n".join(lines)
+
+    def save(self, path: str = None) -> str:
+        """
+        Write the report to a JSON file.
+
+        Args:
+        - path (str): Path of the report, reports/<script>_<start time>.json if None.
+
+        Returns:
+        - str: Path of the report.
+        """
+        if path is None:
+            script = os.path.splitext(os.path.basename(sys.argv[0]))[0] if sys.argv and sys.argv[0] else "run"
+            path = os.path.join(REPORTS_DIR, f"{script}_{datetime.fromtimestamp(self.started).strftime('%Y%m%d_%H%M%S')}.json")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(self.report(), file, indent=2)
+        return path
+
+
+PROFILER = Profiler() # shared by all modules of the pipeline
+
+def stage(name: str, rows_in: int = None):
+    # record a stage with the shared profiler (see Profiler.stage)
+    return PROFILER.stage(name, rows_in)
+
+def progress(iterable = None, desc: str = None, total: int = None, unit: str = "it"):
+    # progress bar of the shared profiler (see Profiler.progress)
+    return PROFILER.progress(iterable, desc, total, unit)
@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import plotly.io as pio
+import tqdm
+
+from TCR_profile import stage
+
+MANIFEST_NAME = ".render_manifest.json" # digests of rendered figures, stored in the output directory
+WORKERS = min(4, os.cpu_count() or 1) # every worker runs its own Kaleido (Chromium) process, more workers exhaust memory on large machines
+
+
+def render_figure(spec: str, path: str) -> str:
+    # Export one figure (plotly JSON) to an image, runs in a worker process with its own Kaleido instance
+    pio.write_image(pio.from_json(spec), path)
+    return path
+
+
+class PlotRenderer:
+    """
+    Queue of figures exported to images on a pool of worker processes.
+    A figure is skipped if its image exists and was rendered from the same figure before.
+    """
+    def __init__(self, workers: int = None, directory: str = "Analysis", progress: bool = True):
+        """
+        Args:
+        - workers (int): Number of worker processes, WORKERS if None. 1 renders in this process.
+        - directory (str): Output directory, the manifest of rendered figures is stored there.
+        - progress (bool): Whether to show a progress bar while rendering.
+        """
+        self.workers = workers or WORKERS
+        self.directory = directory
+        self.progress = progress
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+        self.queue: dict = {} # path -> (spec, digest)
+        self.skipped = 0
+
+        self.manifest: dict = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def add(self, fig, path: str) -> None:
+        """
+        Queue a figure for export. The figure is serialized now, so it can be changed after adding.
+
+        Args:
+        - fig (go.Figure): Figure to export.
+        - path (str): Path of the image.
+        """
+        spec: str = fig.to_json()
+        digest = hashlib.blake2b(spec.encode(), digest_size=16).hexdigest()
+        if os.path.exists(path) and self.manifest.get(path) == digest:
+            self.skipped += 1
+            return
+        self.queue[path] = (spec, digest)
+
+    def render(self) -> None:
+        # Export all queued figures and clear the queue
+        if not self.queue:
+            return
+
+        jobs, self.queue = self.queue, {}
+        progress_bar = tqdm.tqdm(total=len(jobs), desc=f"Rendering plots ({self.skipped} up to date)", unit="plot", disable=not self.progress)
+        with stage("render", len(jobs)) as record:
+            try:
+                if self.workers == 1:
+                    for path, (spec, digest) in jobs.items():
+                        render_figure(spec, path)
+                        self.manifest[path] = digest
+                        progress_bar.update()
+                else:
+                    with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs))) as executor:
+                        futures = {executor.submit(render_figure, spec, path): (path, digest) for path, (spec, digest) in jobs.items()}
+                        for future in as_completed(futures):
+                            path, digest = futures[future]
+                            future.result()
+                            self.manifest[path] = digest
+                            progress_bar.update()
+            finally:
+                record["rows_out"] = progress_bar.n # plots rendered
+                progress_bar.close()
+                self.save_manifest() # figures rendered before a failure are not rendered again
+
+    def save_manifest(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = self.manifest_path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(temporary_path, self.manifest_path)
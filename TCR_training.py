@@ -0,0 +1,139 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import joblib
+import tqdm
+from sklearn.base import clone
+from sklearn.metrics import accuracy_score, balanced_accuracy_score
+from sklearn.model_selection import StratifiedKFold
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+from TCR_cache import fingerprint_data, make_key
+
+MODELS_DIR = "backup/models" # fitted pipelines and metrics of each fold
+IGNORED_PARAMS = ("n_jobs", "verbose") # parameters that do not change the fitted model
+
+
+def fingerprint_estimator(estimator) -> str:
+    """
+    Fingerprint of an estimator and all its (nested) hyperparameters.
+
+    Args:
+    - estimator: Unfitted sklearn estimator.
+
+    Returns:
+    - str: Cache key of the estimator.
+    """
+    params = {name: repr(value) for name, value in estimator.get_params(deep=True).items() if not name.endswith(IGNORED_PARAMS)}
+    return make_key(type(estimator).__name__, **params)
+
+def train_fold(path: str, scaler: StandardScaler, estimator, X_train: np.ndarray, y_train: np.ndarray, X_test: np.ndarray, y_test: np.ndarray) -> dict:
+    """
+    Fit a classifier on one fold of scaled data and store the pipeline (scaler + classifier) with its metrics.
+    Runs in a worker process.
+
+    Args:
+    - path (str): Path of the stored model.
+    - scaler (StandardScaler): Scaler fitted on the training part of the fold.
+    - estimator: Unfitted classifier.
+    - X_train, y_train (np.ndarray): Scaled training data and targets.
+    - X_test, y_test (np.ndarray): Scaled test data and targets.
+
+    Returns:
+    - dict: Metrics of the fold.
+    """
+    # folds already run in parallel, nested parallelism (e.g. VotingClassifier(n_jobs=-1)) deadlocks in a forked worker
+    classifier = clone(estimator)
+    classifier.set_params(**{name: 1 for name, value in classifier.get_params(deep=True).items() if name.endswith("n_jobs") and value not in (None, 1)})
+
+    start = time.perf_counter()
+    classifier.fit(X_train, y_train)
+    fit_time = time.perf_counter() - start
+
+    y_pred = classifier.predict(X_test)
+    metrics = {
+        "accuracy": accuracy_score(y_test, y_pred),
+        "balanced_accuracy": balanced_accuracy_score(y_test, y_pred),
+        "fit_time": fit_time,
+    }
+
+    # atomic write, an interrupted run never leaves a broken model behind
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    joblib.dump({"pipeline": Pipeline([("scaler", scaler), ("clf", classifier)]), "metrics": metrics}, temporary_path)
+    os.replace(temporary_path, path)
+    return metrics
+
+def load_model(path: str) -> Pipeline:
+    # Fitted pipeline stored by run_experiments (see model_path column of its results)
+    return joblib.load(path)["pipeline"]
+
+def run_experiments(datasets: dict, classifiers: dict, n_splits: int = 5, random_state: int = 2, workers: int = None,
+                    models_dir: str = MODELS_DIR, progress: bool = True) -> pd.DataFrame:
+    """
+    Cross-validate every classifier on every dataset. Each fold is trained on a process pool and stored on disk
+    under the fingerprint of the data, the fold and the hyperparameters, so a rerun trains only new or changed combinations.
+    StandardScaler is fitted once for each fold and shared by all classifiers. Models are trained on the columns sorted by name.
+
+    Args:
+    - datasets (dict): Name -> dataset with data (features) and target (categories), e.g. DATASETS of TCR_classifiers.ipynb.
+    - classifiers (dict): Name -> unfitted classifier (without scaler).
+    - n_splits (int): Number of stratified folds.
+    - random_state (int): Seed of the fold split.
+    - workers (int): Number of worker processes, number of CPUs if None. 1 trains in this process.
+    - models_dir (str): Directory of the stored models.
+    - progress (bool): Whether to show a progress bar.
+
+    Returns:
+    - pd.DataFrame: dataset, classifier, fold, metrics, model_path and whether the fold was loaded from disk.
+    """
+    os.makedirs(models_dir, exist_ok=True)
+    estimator_keys = {name: fingerprint_estimator(estimator) for name, estimator in classifiers.items()}
+
+    results: list = []
+    tasks: list = []
+    for dataset_name, dataset in datasets.items():
+        X = pd.DataFrame(dataset.data)
+        X = X[sorted(X.columns, key=str)] # same data in another column order has the same fingerprint
+        y = np.asarray(dataset.target)
+        data_key = fingerprint_data(X.assign(__target__=y))
+        folds = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state).split(X, y)
+
+        for fold, (train, test) in enumerate(folds):
+            scaled = None
+            for classifier_name, estimator in classifiers.items():
+                key = make_key("model", data_key, estimator_keys[classifier_name], n_splits=n_splits, random_state=random_state, fold=fold)
+                path = os.path.join(models_dir, key + ".joblib")
+                row = {"dataset": dataset_name, "classifier": classifier_name, "fold": fold, "model_path": path}
+
+                if os.path.exists(path):
+                    results.append({**row, **joblib.load(path)["metrics"], "cached": True})
+                    continue
+
+                if scaled is None:
+                    # scaler is fitted once per fold, all classifiers of the fold get the same scaled data
+                    scaler = StandardScaler().fit(X.iloc[train])
+                    scaled = (scaler, scaler.transform(X.iloc[train]), y[train], scaler.transform(X.iloc[test]), y[test])
+                tasks.append((row, (path, scaled[0], estimator) + scaled[1:]))
+
+    progress_bar = tqdm.tqdm(total=len(tasks), desc=f"Training ({len(results)} folds cached)", unit="fold", disable=not progress)
+    if workers == 1:
+        for row, arguments in tasks:
+            results.append({**row, **train_fold(*arguments), "cached": False})
+            progress_bar.update()
+    elif tasks:
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(tasks))) as executor:
+            futures = {executor.submit(train_fold, *arguments): row for row, arguments in tasks}
+            for future in as_completed(futures):
+                results.append({**futures[future], **future.result(), "cached": False})
+                progress_bar.update()
+    progress_bar.close()
+
+    return pd.DataFrame(results).sort_values(by=["dataset", "classifier", "fold"]).reset_index(drop=True)
+
+def summarize_experiments(results: pd.DataFrame) -> pd.DataFrame:
+    # Mean and standard deviation of the metrics over folds for each dataset and classifier
+    return results.groupby(["dataset", "classifier"])[["accuracy", "balanced_accuracy", "fit_time"]].agg(["mean", "std"])
@@ -0,0 +1,49 @@
+"""
+Compare clean_data (row-wise apply) with clean_data_vectorized.
+
+Usage (from the repository root):
+    python benchmarks/bench_cleaning.py --rows 1000000
+
+First --rows rows of Databaze/table_productive.csv are used if the file exists, otherwise rows are generated (see synthetic_repertoire.py).
+"""
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from TCR_make_dataset import clean_data, clean_data_vectorized, load_vial_codes
+from synthetic_repertoire import generate_productive, make_vial_codes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000, help="number of rows to clean")
+    args = parser.parse_args()
+
+    if os.path.exists("Databaze/table_productive.csv"):
+        data_df = pd.read_csv("Databaze/table_productive.csv", nrows=args.rows)
+        vial_code_data = load_vial_codes()
+    else:
+        data_df = next(generate_productive(args.rows, chunk_rows=args.rows))
+        vial_code_data = make_vial_codes(300).rename(columns={"Vial code": "patient_id"})
+    print(f"Rows: {len(data_df)}")
+
+    start = time.perf_counter()
+    expected = clean_data(data_df.copy(), vial_code_data, verbose=False)
+    row_wise = time.perf_counter() - start
+    print(f"clean_data:            {row_wise:8.2f} s")
+
+    start = time.perf_counter()
+    result = clean_data_vectorized(data_df.copy(), vial_code_data, verbose=False)
+    vectorized = time.perf_counter() - start
+    print(f"clean_data_vectorized: {vectorized:8.2f} s ({row_wise / vectorized:.1f}x)")
+
+    pd.testing.assert_frame_equal(expected, result, check_dtype=False)
+    print("Outputs are identical")
+
+
+if __name__ == "__main__":
+    main()
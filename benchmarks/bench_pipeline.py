@@ -0,0 +1,116 @@
+"""
+Benchmark pipeline stages on synthetic data (see synthetic_repertoire.py): wall time, peak RSS and throughput of each stage.
+
+Usage (from the repository root):
+    python benchmarks/bench_pipeline.py --rows 1000000 3000000 10000000 30000000 --patients 300 --report bench_report.json
+
+Every table size runs in its own process in --directory/rows_<N>, so peak memory of one size does not affect the others.
+Generated tables are kept and reused by later runs with the same size, patients and seed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+REPOSITORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic_repertoire import write_dataset
+
+
+def run_stages(rows: int) -> list:
+    """
+    Run the pipeline stages in the current directory (with a generated Databaze folder).
+
+    Args:
+    - rows (int): Number of rows of the productive table.
+
+    Returns:
+    - list: Record of each stage.
+    """
+    import TCR_make_dataset
+    from TCR_make_dataset import DATASETS_INFO, clean, export_dataframe, load_raw_data, load_vial_codes, make_datasets
+    from TCR_DATASETS.TCR_load import load_tcr_data, make_vj_region
+    from TCR_DATASETS.TCR_features import aggregate_patient_regions, build_feature_matrix
+    from TCR_graphs import aggregate_categories
+    from TCR_profile import PROFILER, stage
+
+    TCR_make_dataset.BACKUP = False # every run measures the whole work
+    PROFILER.show_progress = False # stdout is the JSON result, progress bars would only slow the stages down
+
+    # stages recorded inside the pipeline (load_raw_data, export/<name>, steps of cleaning and counting) are part of the report too
+    data_df = load_raw_data()
+
+    with stage("clean", rows) as record:
+        data_df = clean(data_df, load_vial_codes(), verbose=False)
+        record["rows_out"] = len(data_df)
+
+    with stage("make_datasets", rows) as record:
+        datasets = make_datasets(data_df, DATASETS_INFO)
+        record["rows_out"] = sum(len(dataset) for dataset in datasets.values())
+    del data_df
+
+    for name, dataset in datasets.items():
+        export_dataframe(dataset, name)
+    dataset_rows = len(datasets["VJ_dependent"])
+    del datasets
+
+    with stage("load_tcr_data", dataset_rows) as record:
+        data_df = load_tcr_data("VJ_DEPENDENT")
+        record["rows_out"] = len(data_df)
+
+    with stage("make_category_dataframes", dataset_rows) as record:
+        data_df["VJ_region"] = make_vj_region(data_df)
+        category_dfs = aggregate_categories("VJ_region", data_df)["frequency"] # without the cache of make_category_dataframes
+        record["rows_out"] = sum(len(category_df) for category_df in category_dfs.values())
+
+    with stage("feature_matrix", dataset_rows) as record:
+        # top 50 regions of each category, same as TCR_classifiers.ipynb
+        regions = list({region for category_df in category_dfs.values() for region in category_df.sort_values(by="output", ascending=False).head(50)["VJ_region"]})
+        features = build_feature_matrix(aggregate_patient_regions(data_df, region_column="VJ_region"), regions, value="ratio")
+        record["rows_out"] = len(features)
+
+    print(PROFILER.summary(), file=sys.stderr)
+    return PROFILER.report()["stages"]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000_000], help="table sizes to benchmark")
+    parser.add_argument("--patients", type=int, default=300, help="number of patients")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generator")
+    parser.add_argument("--directory", default="benchmarks/runs", help="directory of generated tables and outputs")
+    parser.add_argument("--report", default="bench_report.json", help="JSON file with results of all stages")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS) # run stages of one size in this process
+    args = parser.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(run_stages(args.single)))
+        return
+
+    results = []
+    for rows in args.rows:
+        directory = os.path.abspath(os.path.join(args.directory, f"rows_{rows}_patients_{args.patients}_seed_{args.seed}"))
+        if not os.path.exists(os.path.join(directory, "Databaze", "table_productive.csv")):
+            print(f"Generating {rows} rows")
+            write_dataset(directory, rows, args.patients, args.seed)
+
+        print(f"Benchmarking {rows} rows")
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "--single", str(rows)], cwd=directory,
+                                 env={**os.environ, "PYTHONPATH": os.path.abspath(REPOSITORY)}, stdout=subprocess.PIPE, text=True, check=True)
+        for record in json.loads(process.stdout.strip().splitlines()[-1]):
+            results.append({"rows": rows, "patients": args.patients, **record})
+
+    report = pd.DataFrame(results)
+    print(report[["rows", "stage", "seconds", "peak_rss_mb", "rows_per_second"]].to_string(index=False, float_format=lambda value: f"{value:,.1f}"))
+    with open(args.report, "w") as file:
+        json.dump({"python": sys.version.split()[0], "pandas": pd.__version__, "numpy": np.__version__, "cpus": os.cpu_count(), "stages": results}, file, indent=2)
+    print(f"Report saved to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Generate a synthetic productive table (Databaze/table_productive.csv) and vial codes (Databaze/HEDIMED_kodovani.xlsx).
+
+Usage (from the repository root):
+    python benchmarks/synthetic_repertoire.py --rows 1000000 --patients 300 --output /tmp/tcr_bench
+
+Rows look like the real table: TRB clonotypes with V/J segments and deletions/insertions, CDR3 sequences starting with C and
+(mostly) ending with F, both sample name formats and the rare invalid "V" sequence. Clone sizes are skewed - every patient has
+a few large clones and a long tail of small ones, and some clones are public (shared by patients).
+"""
+import argparse
+import os
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+V_GENES = ["V2", "V3-1", "V4-1", "V4-2", "V4-3", "V5-1", "V5-4", "V5-5=V5-6=V5-7", "V5-6", "V6-1", "V6-2=V6-3", "V6-5", "V7-2", "V7-3",
+           "V7-8", "V7-9", "V9", "V10-1", "V10-2", "V10-3", "V11-1=V11-3", "V11-2", "V12-3=V12-4", "V13", "V14", "V15", "V18", "V19",
+           "V20-1", "V24-1", "V25-1", "V27", "V28", "V29-1", "V30"]
+J_GENES = ["J1-1", "J1-2", "J1-3", "J1-4", "J1-5", "J1-6", "J2-1", "J2-2", "J2-3", "J2-4", "J2-5", "J2-6", "J2-7"]
+J_ENDINGS = ["TEAFF", "YGYTF", "GNTIYF", "NEKLFF", "SNQPQHF", "SGNSPLHF", "YNEQFF", "GELFF", "TDTQYF", "KNIQYF", "QETQYF", "GANVLTF", "YEQYF"]
+CATEGORIES = ["Control", "Single AAB", "Multiple AABs", "Celiac_case", "Enterovirus infection"]
+AMINO_ACIDS = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)
+
+CHUNK_ROWS = 1_000_000 # rows generated and written at once
+MAX_CLONES = 3_000_000 # distinct clonotypes in the pool
+PUBLIC_CLONES = 500 # clonotypes shared by many patients
+PUBLIC_RATE = 0.02 # share of rows with a public clonotype
+NON_PRODUCTIVE_RATE = 0.005 # share of CDR3 sequences without the F at the end
+INVALID_RATE = 0.000001 # share of rows with the invalid clonotype_sequence "V"
+CLONE_SKEW = 3.0 # rank of a clone is span * u**CLONE_SKEW, higher = larger top clones
+
+
+def make_patient_ids(patients: int) -> np.ndarray:
+    # 1A1, 1A2, ... - plate, row and column like the real vial codes
+    rows = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    ids = [f"{plate}{row}{column}" for plate in range(1, 10) for row in rows for column in range(1, 10)]
+    if patients > len(ids):
+        raise ValueError(f"At most {len(ids)} patients can be generated")
+    return np.array(ids[:patients])
+
+def make_clone_pool(clones: int, rng: np.random.Generator) -> np.ndarray:
+    # clonotype strings, e.g. "VJ:Vb-(Db)-Jb  V10-1 -18/3/-22 J2-7  CASSLGQAYEQYF"
+    v = rng.choice(len(V_GENES), clones, p=rng.dirichlet(np.full(len(V_GENES), 0.7))) # V usage is skewed
+    j = rng.choice(len(J_GENES), clones, p=rng.dirichlet(np.full(len(J_GENES), 2.0)))
+
+    # random middle of the CDR3, bytes after the length are 0 and dropped by the S dtype
+    middle_lengths = np.clip(np.round(rng.normal(6, 2, clones)), 1, 14).astype(int)
+    middle = AMINO_ACIDS[rng.integers(0, len(AMINO_ACIDS), (clones, 14))]
+    middle[np.arange(14) >= middle_lengths[:, None]] = 0
+    middle = middle.view("S14").ravel().astype(str)
+
+    endings = np.array(J_ENDINGS)[j]
+    non_productive = rng.random(clones) < NON_PRODUCTIVE_RATE
+    endings[non_productive] = np.char.replace(endings[non_productive], "F", "*")
+    cdr3 = np.char.add(np.char.add("CASS", middle), endings)
+
+    tilde = np.where(rng.random(clones) < 0.01, "~", "")
+    deletions = np.char.add(np.char.add(np.char.add(np.char.add("-", rng.integers(0, 45, clones).astype(str)), "/"),
+                                        rng.integers(0, 15, clones).astype(str)), "/-")
+    deletions = np.char.add(deletions, rng.integers(0, 30, clones).astype(str))
+    clonotype = np.char.add(np.char.add(np.char.add("VJ:Vb-(Db)-Jb  ", np.array(V_GENES)[v]), tilde), " ")
+    clonotype = np.char.add(np.char.add(np.char.add(clonotype, deletions), " "), np.array(J_GENES)[j])
+    clonotype = np.char.add(np.char.add(clonotype, "  "), cdr3)
+    return np.stack([clonotype.astype(object), cdr3.astype(object)], axis=1)
+
+def generate_productive(rows: int, patients: int = 300, seed: int = 0, chunk_rows: int = CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """
+    Generate the productive table in chunks.
+
+    Args:
+    - rows (int): Number of rows.
+    - patients (int): Number of patients.
+    - seed (int): Seed of the generator, the same seed gives the same table.
+    - chunk_rows (int): Number of rows in each chunk.
+
+    Returns:
+    - Iterator[pd.DataFrame]: Chunks with sample, clonotype and clonotype_sequence columns.
+    """
+    rng = np.random.default_rng(seed)
+    patient_ids = make_patient_ids(patients)
+    pool = make_clone_pool(int(np.clip(rows // 3, PUBLIC_CLONES + 1, MAX_CLONES)), rng)
+
+    # sequencing depth differs between patients, every patient has its own region of the pool
+    depth = rng.lognormal(0, 0.5, patients)
+    depth /= depth.sum()
+    span = int(np.clip(rows // patients, 100, len(pool)))
+    offsets = rng.integers(PUBLIC_CLONES, len(pool), patients)
+    samples = np.array([f"HEDIMED-{patient}_TRB-VJ_S{i % 120 + 1}_R1_001" if i % 2 else f"{patient}-TRB-VJ_S{i % 120 + 1}_merged_R1"
+                        for i, patient in enumerate(patient_ids)], dtype=object)
+
+    for start in range(0, rows, chunk_rows):
+        size = min(chunk_rows, rows - start)
+        patient = rng.choice(patients, size, p=depth)
+        rank = (span * rng.random(size) ** CLONE_SKEW).astype(np.int64)
+        clone = (offsets[patient] + rank - PUBLIC_CLONES) % (len(pool) - PUBLIC_CLONES) + PUBLIC_CLONES
+        public = rng.random(size) < PUBLIC_RATE
+        clone[public] = rng.integers(0, PUBLIC_CLONES, public.sum())
+
+        chunk = pd.DataFrame({"sample": samples[patient], "clonotype": pool[clone, 0], "clonotype_sequence": pool[clone, 1]})
+        invalid = np.flatnonzero(rng.random(size) < INVALID_RATE)
+        if len(invalid):
+            # sequence "V" of the invalid rows, V of the clonotype is removed by cleaning (see clean_data)
+            chunk.loc[invalid, "clonotype"] = chunk.loc[invalid, "clonotype"].str.rsplit("  ", n=1).str[0] + "  V"
+            chunk.loc[invalid, "clonotype_sequence"] = "V"
+        yield chunk
+
+def make_vial_codes(patients: int, seed: int = 0) -> pd.DataFrame:
+    # category of each patient, same columns as Databaze/HEDIMED_kodovani.xlsx
+    rng = np.random.default_rng(seed + 1)
+    return pd.DataFrame({"Vial code": make_patient_ids(patients), "category": rng.choice(CATEGORIES, patients, p=[0.4, 0.2, 0.15, 0.15, 0.1])})
+
+def write_dataset(directory: str, rows: int, patients: int = 300, seed: int = 0) -> str:
+    """
+    Write Databaze/table_productive.csv and Databaze/HEDIMED_kodovani.xlsx into the directory.
+
+    Args:
+    - directory (str): Directory to run the pipeline in.
+    - rows (int): Number of rows.
+    - patients (int): Number of patients.
+    - seed (int): Seed of the generator.
+
+    Returns:
+    - str: Path of the productive table.
+    """
+    os.makedirs(os.path.join(directory, "Databaze"), exist_ok=True)
+    make_vial_codes(patients, seed).to_excel(os.path.join(directory, "Databaze", "HEDIMED_kodovani.xlsx"), index=False)
+
+    path = os.path.join(directory, "Databaze", "table_productive.csv")
+    for i, chunk in enumerate(generate_productive(rows, patients, seed)):
+        chunk.to_csv(path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+    return path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000, help="number of rows")
+    parser.add_argument("--patients", type=int, default=300, help="number of patients")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generator")
+    parser.add_argument("--output", default="synthetic", help="directory with the generated Databaze folder")
+    args = parser.parse_args()
+
+    path = write_dataset(args.output, args.rows, args.patients, args.seed)
+    print(f"{args.rows} rows of {args.patients} patients written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+import pytest
+
+import TCR_make_dataset
+from benchmarks.synthetic_repertoire import write_dataset
+
+
+@pytest.fixture
+def repertoire(tmp_path, monkeypatch):
+    # tiny synthetic Databaze folder (see benchmarks/synthetic_repertoire.py), tests run in its directory without the backup cache
+    write_dataset(str(tmp_path), rows=5000, patients=20)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(TCR_make_dataset, "BACKUP", False)
+    return tmp_path
@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+
+from TCR_make_dataset import DATASETS_INFO, clean, load_raw_data, load_vial_codes, make_datasets
+from TCR_DATASETS.TCR_diversity import CLONE_COLUMNS, DiversitySketch
+
+
+def test_merge(repertoire):
+    # sketches of disjoint parts of the rows merge to the sketch of one pass, richness is the exact number of clones
+    dataset = make_datasets(clean(load_raw_data(), load_vial_codes(), verbose=False), DATASETS_INFO)["VJ_dependent"]
+    expected = DiversitySketch().update(dataset).statistics()
+    clones = dataset.drop_duplicates(["patient_id"] + CLONE_COLUMNS).groupby("patient_id").size()
+    assert (expected["richness"].to_numpy() == clones.reindex(expected["patient_id"]).to_numpy()).all()
+
+    shuffled = dataset.sample(frac=1, random_state=0)
+    merged = DiversitySketch()
+    for part in range(3):
+        merged.merge(DiversitySketch().update(shuffled.iloc[part::3]))
+    pd.testing.assert_frame_equal(expected, merged.statistics())
+
+    # parts that share clones: richness of the patients is estimated by HyperLogLog and every clone is counted once
+    overlapping = DiversitySketch().update(dataset).merge(DiversitySketch().update(dataset.iloc[::2]), disjoint=False).statistics()
+    assert np.allclose(overlapping["richness"], expected["richness"], rtol=0.1)
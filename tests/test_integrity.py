@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import TCR_DATASETS.TCR_load as TCR_load
+from TCR_DATASETS.integrity import check_dataset
+
+
+@pytest.fixture
+def corrupted(tmp_path, monkeypatch):
+    # VJ_DEPENDENT of three patients with one corruption of each kind, expected row indices of each check
+    file_path, dtypes = TCR_load.data_sources["VJ_DEPENDENT"]
+    file_path = str(tmp_path / os.path.basename(file_path))
+    monkeypatch.setitem(TCR_load.data_sources, "VJ_DEPENDENT", (file_path, dtypes))
+
+    rows = 12
+    df = pd.DataFrame({
+        "patient_id": np.repeat(["1A1", "1A2", "1A3"], 4),
+        "clonotype_sequence": [f"CASS{'G' * row}F" for row in range(rows)],
+        "specific_seq_count": np.arange(1, rows + 1),
+        "ratio": 0.1,
+        "category": np.repeat(["Control", "Celiac_case", "Control"], 4),
+        "V_region": "V5-1",
+        "J_region": "J2-7",
+    })
+    df.loc[2] = df.loc[1]
+    df.loc[5, "V_region"] = "X1"
+    df.loc[6, "J_region"] = np.nan
+    df.loc[7, "category"] = "Unknown"
+    df.loc[8, "clonotype_sequence"] = "CASSX"
+    df.loc[9, "ratio"] = 1.5
+    df.loc[10, "specific_seq_count"] = 0
+    df.loc[rows] = df.loc[0].copy()
+    df.loc[rows, "clonotype_sequence"] = "CASSQF" # patient 1A1 again, after other patients
+    df.to_csv(file_path, index=False)
+
+    return {
+        "duplicates": [2],
+        "missing_values": [6],
+        "unknown_category": [7],
+        "invalid_category": [7],
+        "mixed_category": [7],
+        "invalid_V_region": [5],
+        "invalid_J_region": [],
+        "invalid_sequence": [8],
+        "invalid_count": [10],
+        "invalid_ratio": [9],
+        "unsorted_patients": [rows],
+    }
+
+
+@pytest.mark.parametrize("chunksize", [1, 5, 100])
+def test_check_dataset(corrupted, chunksize):
+    # offending rows are found the same way whether patients and duplicates span chunks or not
+    report = check_dataset("VJ_DEPENDENT", chunksize=chunksize, categories=["Control", "Celiac_case"])
+    assert report["rows"] == 13
+    assert report["failed"] == {check: {"count": len(rows), "rows": rows} for check, rows in corrupted.items() if rows}
+
+def test_check_dataset_max_rows(corrupted):
+    # all offending rows are counted, only max_rows row indices are kept (0 keeps all)
+    file_path = TCR_load.data_sources["VJ_DEPENDENT"][0]
+    pd.read_csv(file_path).assign(ratio=2.0).to_csv(file_path, index=False)
+
+    assert check_dataset("VJ_DEPENDENT", max_rows=3)["failed"]["invalid_ratio"] == {"count": 13, "rows": [0, 1, 2]}
+    assert check_dataset("VJ_DEPENDENT", max_rows=0)["failed"]["invalid_ratio"] == {"count": 13, "rows": list(range(13))}
@@ -0,0 +1,54 @@
+import pandas as pd
+
+from TCR_make_dataset import (DATASETS_INFO, clean, clean_data, clean_data_vectorized, load_raw_data, load_vial_codes, make_dataset, make_datasets,
+                              make_datasets_partitioned, make_datasets_streaming, make_patient_ids, update_datasets)
+from TCR_DATASETS.TCR_load import load_tcr_data
+
+
+def assert_same_datasets(expected: dict, result: dict) -> None:
+    # exported datasets are written without index, so only rows in order and their values have to match
+    assert list(result) == list(expected)
+    for name, dataset in expected.items():
+        pd.testing.assert_frame_equal(dataset.reset_index(drop=True), result[name].reset_index(drop=True), check_dtype=False)
+
+def reference_datasets() -> dict:
+    # datasets made one by one by make_dataset from the whole cleaned table
+    cleaned = clean(load_raw_data(), load_vial_codes(), verbose=False)
+    return {name: make_dataset(cleaned, group_by=group_by, drop=drop) for group_by, drop, name in DATASETS_INFO}
+
+
+def test_make_datasets(repertoire):
+    # all datasets derived from one shared count of encoded rows
+    assert_same_datasets(reference_datasets(), make_datasets(clean(load_raw_data(), load_vial_codes(), verbose=False), DATASETS_INFO))
+
+def test_make_datasets_streaming(repertoire):
+    # chunks smaller than a patient, counts of a patient are merged across chunks
+    assert_same_datasets(reference_datasets(), make_datasets_streaming(DATASETS_INFO, chunksize=700))
+
+def test_clean_data_vectorized(repertoire):
+    # both sample formats, the rare invalid "V" sequence and patients missing in the vial codes are cleaned the same way
+    raw, vial_code_data = load_raw_data(), load_vial_codes()
+    raw.loc[0, ["clonotype", "clonotype_sequence"]] = [raw.loc[0, "clonotype"].rsplit("  ", 1)[0] + "  V", "V"]
+    vial_code_data = vial_code_data.iloc[1:] # first patient gets category Unknown
+    expected = clean_data(raw.copy(), vial_code_data, verbose=False)
+    pd.testing.assert_frame_equal(expected, clean_data_vectorized(raw.copy(), vial_code_data, verbose=False), check_dtype=False)
+
+def test_make_datasets_partitioned(repertoire):
+    # raw table cleaned and counted in 3 worker processes, patients are never split between partitions
+    assert_same_datasets(reference_datasets(), make_datasets_partitioned(DATASETS_INFO, workers=3))
+
+def test_update_datasets(repertoire):
+    # incremental update after a patient is added, changed and removed gives the datasets of a full rebuild
+    table = pd.read_csv("Databaze/table_productive.csv")
+    patient_ids = make_patient_ids(table["sample"]).to_numpy()
+    new_patient, changed_patient, removed_patient = pd.unique(patient_ids)[:3]
+
+    previous = table[patient_ids != new_patient].drop(table.index[patient_ids == changed_patient][:10])
+    previous.to_csv("Databaze/table_productive.csv", index=False)
+    update_datasets(DATASETS_INFO, chunksize=1000) # no previous build, all patients are built
+
+    table[patient_ids != removed_patient].to_csv("Databaze/table_productive.csv", index=False)
+    update_datasets(DATASETS_INFO, chunksize=1000)
+
+    updated = {name: load_tcr_data(name.upper(), categorical=False) for _, _, name in DATASETS_INFO}
+    assert_same_datasets(reference_datasets(), updated)
@@ -0,0 +1,31 @@
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from TCR_DATASETS.TCR_similarity import build_similarity_index
+
+
+@pytest.mark.parametrize("max_mismatches", [1, 2])
+def test_neighbor_pairs(max_mismatches):
+    # short sequences of a small alphabet have many neighbors, pairs are compared with brute-force Hamming distances
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(3, 7, 300)
+    sequences = ["C" + "".join(rng.choice(list("AST"), length)) + "F" for length in lengths]
+    data_df = pd.DataFrame({"patient_id": rng.choice(["1A1", "1A2", "1A3"], len(sequences)), "clonotype_sequence": sequences,
+                            "category": "Control"})
+    index = build_similarity_index(data_df)
+
+    expected = set()
+    for a, b in combinations(sorted(set(sequences)), 2):
+        mismatches = sum(x != y for x, y in zip(a, b))
+        if len(a) == len(b) and mismatches <= max_mismatches:
+            expected.add((a, b, mismatches))
+
+    pairs = index.neighbor_pairs(max_mismatches)
+    assert (pairs["id_a"] < pairs["id_b"]).all()
+    sequences_a, sequences_b = index.decode(pairs["id_a"]), index.decode(pairs["id_b"])
+    result = {(min(a, b), max(a, b), mismatches) for a, b, mismatches in zip(sequences_a, sequences_b, pairs["mismatches"])}
+    assert len(result) == len(pairs)
+    assert result == expected
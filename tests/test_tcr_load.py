@@ -0,0 +1,40 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+
+import TCR_DATASETS.TCR_load as TCR_load
+from TCR_DATASETS.TCR_load import make_vj_region
+
+
+def test_make_vj_region_missing_regions():
+    # rows with a missing V or J region have no VJ_region, for categorical and string regions alike
+    regions = pd.DataFrame({"V_region": ["V1", "V2", None, "V1"], "J_region": ["J1", None, "J2", "J1"]})
+    categorical = regions.astype("category")
+
+    vj_region = make_vj_region(categorical)
+    assert isinstance(vj_region.dtype, pd.CategoricalDtype)
+    assert vj_region.isna().tolist() == [False, True, True, False]
+    assert vj_region.dropna().astype(str).tolist() == ["V1_J1", "V1_J1"]
+    assert list(vj_region.cat.categories) == ["V1_J1"]
+
+    strings = make_vj_region(regions)
+    assert strings.isna().tolist() == vj_region.isna().tolist()
+    assert (strings.dropna() == vj_region.dropna().astype(str)).all()
+
+def test_stale_parquet_is_ignored(tmp_path, monkeypatch):
+    # a CSV exported after the Parquet/Arrow files is read instead of them
+    file_path, dtypes = TCR_load.data_sources["VJ_INDEPENDENT"]
+    file_path = str(tmp_path / os.path.basename(file_path))
+    monkeypatch.setitem(TCR_load.data_sources, "VJ_INDEPENDENT", (file_path, dtypes))
+
+    old = pd.DataFrame({"patient_id": ["P1"], "category": ["T1D"], "clonotype_sequence": ["CASSF"], "specific_seq_count": [1], "ratio": [1.0]})
+    new = old.assign(specific_seq_count=[2])
+    old.to_csv(file_path, index=False)
+    TCR_load.save_tcr_data(old, file_path)
+    new.to_csv(file_path, index=False)
+    os.utime(file_path, (time.time() + 10, time.time() + 10))
+
+    assert TCR_load.load_tcr_data("VJ_INDEPENDENT")["specific_seq_count"].tolist() == [2]
+    assert next(TCR_load.iter_tcr_data("VJ_INDEPENDENT"))["specific_seq_count"].tolist() == [2]
+    assert TCR_load.load_tcr_data("VJ_INDEPENDENT", lazy=True).to_pandas()["specific_seq_count"].tolist() == [2]